@@ -68,6 +68,7 @@ from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import or_
 from random import randrange
 from werkzeug.middleware.proxy_fix import ProxyFix
+from blog.compression import CompressionMiddleware
 from logging.handlers import RotatingFileHandler
 
 
@@ -77,6 +78,21 @@ def create_app(test_config=None):
     app = Flask(__name__)
     # Database connection string
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///blog.db'
+    # SQLite settings which will be applied to every new connection
+    app.config['SQLITE_PRAGMAS'] = {
+        # Readers won't block writers and writers won't block readers
+        'journal_mode': 'WAL',
+        # Wait up to 5 seconds for the lock instead of 'database is locked'
+        'busy_timeout': 5000,
+        # Safe with WAL and doesn't fsync on every commit
+        'synchronous': 'NORMAL',
+        # 16 MiB page cache for each connection (negative value is in KiB)
+        'cache_size': -16384,
+        # Read the database file using 256 MiB memory-mapped I/O
+        'mmap_size': 268435456,
+        # Keep temporary tables and indices in memory
+        'temp_store': 'MEMORY',
+    }
     # Because we don't need it
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     app.config['PRESERVE_CONTEXT_ON_EXCEPTION'] = False
@@ -84,10 +100,41 @@ def create_app(test_config=None):
     app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
     app.config['SESSION_COOKIE_HTTPONLY'] = True
     # Flask-Caching related configs
-    app.config["CACHE_TYPE"] = "simple"
+    # The cache is stored in a sqlite file so all the worker processes
+    # share the same cache (and see the same invalidations)
+    # It's next to the package (like blog.db) and not in the current
+    # directory so all the workers use the same file
+    app.config["CACHE_TYPE"] = "blog.sqlitecache.sqlite"
+    app.config["CACHE_SQLITE_PATH"] = os.path.join(app.root_path, "cache.db")
+    # Maximum number of the cached items
+    # (least recently used items will be removed)
+    app.config["CACHE_THRESHOLD"] = 2000
     app.config["CACHE_DEFAULT_TIMEOUT"] = 300
+    # Maximum number of the formatted dates which each worker keeps
+    app.config['DATETIME_CACHE_SIZE'] = 4096
+    # Clicks on hashtags are counted in memory and hashtag popularity
+    # is saved to the database every 60 seconds or every 100 clicks
+    app.config['TAG_CLICKS_FLUSH_INTERVAL'] = 60
+    app.config['TAG_CLICKS_FLUSH_COUNT'] = 100
+    # Keywords of the existing hashtags are reloaded every 60 seconds
+    app.config['TAG_KEYWORDS_TIMEOUT'] = 60
+    # Most popular hashtags of the sidebar are refreshed every 60 seconds
+    app.config['POPULAR_TAGS_TIMEOUT'] = 60
+    # Responses which are smaller than 512 bytes aren't compressed
+    app.config['COMPRESS_MIN_SIZE'] = 512
+    app.config['COMPRESS_LEVEL'] = 6
     # Assign a 32 bytes length random value to app.secret_key
     app.secret_key = os.urandom(32)
     app.wsgi_app = ProxyFix(app.wsgi_app)
+    # Override the default configurations (for example in tests) or
+    # load them from the file which BLOG_SETTINGS points to (if there's any)
+    if test_config is not None:
+        app.config.from_mapping(test_config)
+    else:
+        app.config.from_envvar('BLOG_SETTINGS', silent=True)
+    # Compress the responses (gzip or zstd if the client accepts it)
+    app.wsgi_app = CompressionMiddleware(
+        app.wsgi_app, minimumSize=app.config['COMPRESS_MIN_SIZE'],
+        level=app.config['COMPRESS_LEVEL'])
     # Return app
     return app
@@ -9,12 +9,21 @@
 import os
 import re
 import datetime
+import calendar
 import jdatetime
 import json
 import hashlib
 import urllib.parse
 import functools
+import types
+import mimetypes
+import collections
 import logging
+import threading
+import atexit
+import time
+import click
+import sqlite3
 
 from blog import *
 from flask import (
@@ -30,6 +39,9 @@ from flask import (
     escape,
     session,
     flash,
+    g,
+    has_request_context,
+    send_from_directory,
 )
 from wtforms.validators import (
     InputRequired,
@@ -61,16 +73,34 @@ from wtforms import (
 from flask_wtf.csrf import (
     CSRFProtect,
     CSRFError,
+    generate_csrf,
 )
 from flask_wtf import FlaskForm
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_caching import Cache
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import or_
+from sqlalchemy.engine import Engine
+from sqlalchemy import (
+    or_,
+    and_,
+    event,
+    DDL,
+    table,
+    column,
+    literal_column,
+)
 from random import randrange
 from werkzeug.middleware.proxy_fix import ProxyFix
 from logging.handlers import RotatingFileHandler
+from blog.compression import negotiateEncoding, compress
+from blog.assets import (
+    ASSETS_DIR,
+    buildAssets,
+    loadManifest,
+    fontCharacters,
+    subsetFonts,
+)
 
 # self.app = app
 app = create_app()
@@ -85,6 +115,8 @@ db = SQLAlchemy(app)
 cache = Cache(app)
 # Global config object
 cfg = {}
+# Version of the loaded config file (see getConfigVersion())
+cfgVersion = None
 # Config file
 CONFIG_FILE = 'config.json'
 # Log file
@@ -107,6 +139,117 @@ logger.setLevel(logging.INFO)
 logger.addHandler(logHandler)
 
 
+# Oldest sqlite library which supports our statements
+# (INSERT ... ON CONFLICT DO UPDATE needs sqlite 3.24)
+SQLITE_MIN_VERSION = (3, 24, 0)
+if sqlite3.sqlite_version_info < SQLITE_MIN_VERSION:
+    raise RuntimeError(
+        'sqlite %s or newer is required but python uses sqlite %s' %
+        ('.'.join(map(str, SQLITE_MIN_VERSION)), sqlite3.sqlite_version))
+
+
+# This function will apply the sqlite settings to every new connection
+@event.listens_for(Engine, 'connect')
+def setPragmas(connection, record):
+    '''
+    Applies the SQLITE_PRAGMAS settings to a new sqlite connection
+    '''
+    # Ignore other databases
+    if not isinstance(connection, sqlite3.Connection):
+        return
+    cursor = connection.cursor()
+    for name, value in app.config.get('SQLITE_PRAGMAS', {}).items():
+        cursor.execute('PRAGMA %s = %s' % (name, value))
+    cursor.close()
+
+
+# Names of the contents which cached responses are generated from
+GENERATIONS = ('posts', 'comments', 'categories', 'config', 'links', 'tags')
+# Contents which the cached pages are generated from
+PAGE_GENERATIONS = ('posts', 'comments', 'categories', 'config')
+# Hits and misses of the cached responses in this worker process
+# (for example : cacheStats['page', 'hits'])
+cacheStats = collections.Counter()
+
+
+# This function returns the generations of the cached contents
+def getGenerations(*names) -> str:
+    '''
+    Returns the generations of the given contents (each generation
+    changes whenever its content changes so we can add them to the keys
+    of the cached responses and the old responses won't be used anymore)
+
+    Parameters
+    ----------
+    names : str
+            Names of the contents (see GENERATIONS)
+
+    Returns
+    -------
+    str
+            Generations of the contents joined by dots
+    '''
+    keys = ['generation/' + name for name in names]
+    generations = cache.get_many(*keys)
+    for i, generation in enumerate(generations):
+        # Start a new generation if it doesn't exist in the cache
+        # (a new one is always different from the evicted one)
+        if generation is None:
+            generation = int(time.time() * 1000000)
+            cache.add(keys[i], generation, timeout=0)
+            # Another process may have added it first
+            # (the new one is used if the cache can't be read, so nothing
+            # which is cached using an unknown generation is used)
+            generations[i] = cache.get(keys[i]) or generation
+    return '.'.join(map(str, generations))
+
+
+# This function changes the generations of the cached contents
+def bumpGenerations(*names):
+    '''
+    Changes the generations of the given contents so the cached
+    responses which are generated using the old contents won't be used
+    (call it after saving the changes to the database)
+
+    Parameters
+    ----------
+    names : str
+            Names of the contents (see GENERATIONS)
+    '''
+    # New generation is the current time in microseconds
+    # (time.time_ns() isn't available in python 3.6)
+    generation = int(time.time() * 1000000)
+    cache.set_many({'generation/' + name: generation for name in names},
+                   timeout=0)
+
+
+# Date/Time format of the date/time strings stored in the database
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+# This function converts the date/time strings to timestamps
+def toTimestamp(strDateTime: str) -> int:
+    '''
+    Converts a date/time string to number of seconds since
+    1970-01-01 00:00:00, date/time strings are in the blog's local time
+    and there's no timezone conversion (use datetime.utcfromtimestamp()
+    to convert the timestamp back to the same date/time)
+
+    Parameters
+    ----------
+    strDateTime : str
+            a string which must contain a Date/Time
+            in '%Y-%m-%d %H:%M:%S' format
+
+    Returns
+    -------
+    int
+            number of seconds since 1970-01-01 00:00:00
+    '''
+    gdt = datetime.datetime.strptime(strDateTime, DATETIME_FORMAT)
+    return calendar.timegm(gdt.timetuple())
+
+
 # Order Columns are currently not being used but we'll use them in the future!
 class dbcategory(db.Model):  # Category Class (Categories Table)
     # Category ID (Primary Key)
@@ -142,17 +285,49 @@ class dbpost(db.Model):  # Post Class (Posts Table)
     title = db.Column('title', db.String(32), nullable=True)
     # Post Content
     content = db.Column('content', db.Text, nullable=False)
+    # Post Content as HTML (rendered by renderContent() whenever the content
+    # changes, its links are relative to the blog's root address)
+    html = db.Column('html', db.Text, nullable=False, server_default='')
+    # First 512 characters of the post content as HTML
+    # (empty if the whole post is short enough to be shown on the main page)
+    excerpt = db.Column('excerpt', db.Text, nullable=False, server_default='')
+    # Version of the renderer which rendered html and excerpt
+    renderer = db.Column('renderer',
+                         db.Integer,
+                         nullable=False,
+                         server_default='0')
     # Post Date/Time
     gdatetime = db.Column('datetime', db.String(24), nullable=False)
+    # Post Date/Time as seconds since 1970-01-01 00:00:00 (blog's local time)
+    timestamp = db.Column('timestamp',
+                          db.Integer,
+                          nullable=False,
+                          server_default='0',
+                          index=True)
     # Number of comments on each post
     comments = db.Column('comments', db.Integer, nullable=False)
+    # Number of approved comments on each post (shown to users)
+    approved_comments = db.Column('approved_comments',
+                                  db.Integer,
+                                  nullable=False,
+                                  server_default='0')
     # Multimedia File (Image) Address
     mediaaddr = db.Column('mediaaddr', db.String(256), nullable=True)
     # Post Flags (NoComment=1, Pinned=2)
     flags = db.Column('flags', db.Integer, nullable=False)
+    # Pinned Flag (a copy of flags & 2 which can be indexed)
+    pinned = db.Column('pinned', db.Integer, nullable=False, server_default='0')
     # Defining a foreign key (backref to pid in comments table!)
     posts = db.relationship('dbcomment',
                             backref=db.backref("dbcomment", uselist=False))
+    # Indexes used by sort orders of the main page (with or without category)
+    __table_args__ = (
+        db.Index('ix_dbpost_pinned_postid', 'pinned', 'postid'),
+        db.Index('ix_dbpost_pinned_comments_postid', 'pinned', 'comments',
+                 'postid'),
+        db.Index('ix_dbpost_category_pinned_postid', 'category', 'pinned',
+                 'postid'),
+    )
 
     def __init__(self, title: str, content: str, gdatetime: str, comments: int,
                  category: int, mediaaddr: str, flags: int):
@@ -161,9 +336,29 @@ class dbpost(db.Model):  # Post Class (Posts Table)
         self.category = category  # Post Category
         self.gdatetime = gdatetime  # Post Date/Time
         self.comments = comments  # Number of comments on each post
+        self.approved_comments = 0  # Number of approved comments
         self.mediaaddr = mediaaddr  # Multimedia File (Image) Address
         self.flags = flags  # Post Flags
 
+    # Update the timestamp whenever the date/time changes
+    @db.validates('gdatetime')
+    def validateDateTime(self, key: str, gdatetime: str) -> str:
+        self.timestamp = toTimestamp(gdatetime)
+        return gdatetime
+
+    # Update the pinned flag whenever the flags change
+    @db.validates('flags')
+    def validateFlags(self, key: str, flags: int) -> int:
+        self.pinned = 1 if (flags & 2) == 2 else 0
+        return flags
+
+    # Render the content whenever it changes
+    @db.validates('content')
+    def validateContent(self, key: str, content: str) -> str:
+        self.html, self.excerpt = renderContent(content)
+        self.renderer = RENDERER_VERSION
+        return content
+
 
 class dbcomment(db.Model):  # Comment Class (Comments Table)
     # Comment ID (Primary Key)
@@ -174,12 +369,18 @@ class dbcomment(db.Model):  # Comment Class (Comments Table)
     # Post ID (Foreign Key)
     pid = db.Column('postid',
                     db.Integer,
-                    db.ForeignKey('dbpost.postid'),
+                    db.ForeignKey('dbpost.postid', ondelete='CASCADE'),
                     nullable=False)
     # Comment Content
     content = db.Column('content', db.String(256), nullable=False)
     # Comment Date/Time
     gdatetime = db.Column('datetime', db.String(20), nullable=False)
+    # Comment Date/Time as seconds since 1970-01-01 00:00:00 (local time)
+    timestamp = db.Column('timestamp',
+                          db.Integer,
+                          nullable=False,
+                          server_default='0',
+                          index=True)
     # Comment's Author's Name
     name = db.Column('name', db.String(24), nullable=False)
     # Comment's Author's Website
@@ -188,6 +389,12 @@ class dbcomment(db.Model):  # Comment Class (Comments Table)
     emailaddr = db.Column('emailaddr', db.String(40), nullable=True)
     # Comment Status (Seen=1, Approved=2)
     status = db.Column('status', db.Integer, nullable=False)
+    # Indexes used for finding the comments of a post
+    # and the comments that require approval
+    __table_args__ = (
+        db.Index('ix_dbcomment_postid_status', 'postid', 'status'),
+        db.Index('ix_dbcomment_status_commentid', 'status', 'commentid'),
+    )
 
     def __init__(self, pid: int, content: str, gdatetime: str, name: str,
                  website: str, emailaddr: str, status: int):
@@ -199,6 +406,12 @@ class dbcomment(db.Model):  # Comment Class (Comments Table)
         self.emailaddr = emailaddr  # Comment Author's EMail Address
         self.status = status  # Comment Status
 
+    # Update the timestamp whenever the date/time changes
+    @db.validates('gdatetime')
+    def validateDateTime(self, key: str, gdatetime: str) -> str:
+        self.timestamp = toTimestamp(gdatetime)
+        return gdatetime
+
 
 class dbtag(db.Model):  # Tag Class (Tags Table)
     # Tag ID (Primary Key)
@@ -209,9 +422,9 @@ class dbtag(db.Model):  # Tag Class (Tags Table)
     # Tag Keyword
     keyword = db.Column('keyword', db.String(512), nullable=False, unique=True)
     # Tag Frequency
-    frequency = db.Column('frequency', db.Integer, nullable=False)
+    frequency = db.Column('frequency', db.Integer, nullable=False, index=True)
     # Tag Popularity
-    popularity = db.Column('popularity', db.Integer, nullable=False)
+    popularity = db.Column('popularity', db.Integer, nullable=False, index=True)
 
     def __init__(self, keyword: str, frequency: int, popularity: int):
         self.keyword = keyword  # Tag Keyword
@@ -219,6 +432,27 @@ class dbtag(db.Model):  # Tag Class (Tags Table)
         self.popularity = popularity  # Tag Popularity
 
 
+class dbposttag(db.Model):  # Post Tag Class (Posts <-> Tags Table)
+    __tablename__ = 'post_tags'
+    # Post ID (Foreign Key)
+    postid = db.Column('postid',
+                       db.Integer,
+                       db.ForeignKey('dbpost.postid', ondelete='CASCADE'),
+                       primary_key=True)
+    # Tag ID (Foreign Key)
+    tagid = db.Column('tagid',
+                      db.Integer,
+                      db.ForeignKey('dbtag.tagid', ondelete='CASCADE'),
+                      primary_key=True)
+    # Index for finding the posts of a hashtag
+    # (primary key index is used for finding the hashtags of a post)
+    __table_args__ = (db.Index('ix_post_tags_tagid', 'tagid', 'postid'), )
+
+    def __init__(self, postid: int, tagid: int):
+        self.postid = postid  # Post ID (Foreign Key)
+        self.tagid = tagid  # Tag ID (Foreign Key)
+
+
 class dblink(db.Model):  # Link Class (Links Table)
     # Link ID (Primary Key)
     linkid = db.Column('linkid',
@@ -238,24 +472,214 @@ class dblink(db.Model):  # Link Class (Links Table)
         self.order = order  # Link Order
 
 
+# Lightweight (read-only) views of the posts and comments which are
+# sent to the templates, listing queries load only these columns
+# instead of loading the whole models
+PostView = collections.namedtuple('PostView', [
+    'postid', 'title', 'content', 'datetime', 'gdatetime', 'category',
+    'mediaaddr', 'pinned', 'comments'])
+CommentView = collections.namedtuple('CommentView', [
+    'cmtid', 'pid', 'content', 'datetime', 'name', 'website', 'emailaddr',
+    'status'])
+# Views of the sidebar items (cached by sidebar())
+CategoryView = collections.namedtuple('CategoryView', ['catid', 'name'])
+TagView = collections.namedtuple('TagView', ['keyword'])
+LinkView = collections.namedtuple('LinkView', ['linkid', 'name', 'address'])
+
+
+# Full-text search index of the posts (SQLite FTS5 virtual table)
+# It's an external content table which only keeps the index and reads
+# title and content from the posts table, the triggers keep it in sync
+# with the posts table on every insert, update and delete
+postsearch = table('dbpostsearch', column('rowid'), column('rank'),
+                   column('dbpostsearch'))
+# Statements that create the search index and its triggers
+SEARCH_INDEX_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS dbpostsearch USING fts5(" + \
+        "title, content, content='dbpost', content_rowid='postid')",
+    "CREATE TRIGGER IF NOT EXISTS dbpostsearch_insert " + \
+        "AFTER INSERT ON dbpost BEGIN " + \
+        "INSERT INTO dbpostsearch(rowid, title, content) " + \
+        "VALUES (new.postid, new.title, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS dbpostsearch_delete " + \
+        "AFTER DELETE ON dbpost BEGIN " + \
+        "INSERT INTO dbpostsearch(dbpostsearch, rowid, title, content) " + \
+        "VALUES ('delete', old.postid, old.title, old.content); END",
+    "CREATE TRIGGER IF NOT EXISTS dbpostsearch_update " + \
+        "AFTER UPDATE OF title, content ON dbpost BEGIN " + \
+        "INSERT INTO dbpostsearch(dbpostsearch, rowid, title, content) " + \
+        "VALUES ('delete', old.postid, old.title, old.content); " + \
+        "INSERT INTO dbpostsearch(rowid, title, content) " + \
+        "VALUES (new.postid, new.title, new.content); END",
+)
+
+
+# db.create_all() will call this function after creating the posts table
+@event.listens_for(dbpost.__table__, 'after_create')
+def createSearchIndex(target, connection, **kw):
+    '''
+    Creates the full-text search index and the triggers
+    which keep it in sync with the posts table
+    '''
+    for statement in SEARCH_INDEX_DDL:
+        connection.execute(DDL(statement))
+
+
+# db.drop_all() will call this function before dropping the posts table
+# (triggers will be dropped with the posts table itself)
+@event.listens_for(dbpost.__table__, 'before_drop')
+def dropSearchIndex(target, connection, **kw):
+    '''
+    Drops the full-text search index
+    '''
+    connection.execute(DDL('DROP TABLE IF EXISTS dbpostsearch'))
+
+
+# This function will (re)build the search index from the posts table
+def rebuildSearchIndex():
+    '''
+    Creates the full-text search index if it doesn't exist
+    (databases created before adding the search index)
+    and rebuilds its content from the posts table
+    '''
+    with db.engine.begin() as connection:
+        createSearchIndex(dbpost.__table__, connection)
+        connection.execute(DDL(
+            "INSERT INTO dbpostsearch(dbpostsearch) VALUES ('rebuild')"))
+
+
+# This function converts the search string to a full-text search query
+def searchQuery(search: str) -> str:
+    '''
+    Converts the user's search string to an FTS5 query which matches
+    the posts that contain all the words of the search string
+    (each word may also be the beginning of a longer word)
+
+    Parameters
+    ----------
+    search : str
+            Search string entered by user
+
+    Returns
+    -------
+    str
+            FTS5 query string or an empty string
+            if there's no word in the search string
+    '''
+    # Quote each word so FTS5 operators in the search string
+    # will be treated as plain text and add * for prefix matching
+    return ' '.join('"' + word + '"*' for word in re.findall(r'\w+', search))
+
+
+# Translations file (it's next to this module)
+TRANSLATIONS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'translation.json')
+# Names of the days of the week (in the order of datetime.weekday())
+DAYS = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday',
+        'Sunday')
+# Names of the jalali months
+JALALI_MONTHS = ('Farvardin', 'Ordibehesht', 'Khordad', 'Tir', 'Mordad',
+                 'Shahrivar', 'Mehr', 'Aban', 'Azar', 'Dey', 'Bahman',
+                 'Esfand')
+# Names of the gregorian months
+GREGORIAN_MONTHS = ('January', 'February', 'March', 'April', 'May', 'June',
+                    'July', 'August', 'September', 'October', 'November',
+                    'December')
+# A compiled translation catalog (it's never modified after loading,
+# a new catalog replaces it when the translations file changes)
+# strings: read-only mapping of the english strings to the translations
+# days: translated names of the days (days[datetime.weekday()])
+# jmonths, gmonths: translated names of the months (jmonths[month], 1-12)
+Translations = collections.namedtuple(
+    'Translations', ['version', 'strings', 'days', 'jmonths', 'gmonths'])
+# The catalog which is used by this process
+translations = None
+translationsLock = threading.Lock()
+
+
+# This function will check if the translations file is changed
+def getTranslationsVersion():
+    '''
+    Returns the modification time, inode and size of the translations file
+    (the file is checked once in each request)
+
+    Returns
+    -------
+    (int, int, int)
+            Modification time, inode and size of the translations file
+            or None if the translations file doesn't exist
+    '''
+    # We'll save the version in the request environment
+    environ = request.environ if has_request_context() else {}
+    if 'blog.translations_version' not in environ:
+        try:
+            stat = os.stat(TRANSLATIONS_FILE)
+            environ['blog.translations_version'] = (stat.st_mtime_ns,
+                                                    stat.st_ino, stat.st_size)
+        except FileNotFoundError:
+            environ['blog.translations_version'] = None
+    return environ['blog.translations_version']
+
+
 # This function will open the translations.json file
-# and returns its data as a dictionary
-@cache.memoize()
-def getTranslations():
-    ''' Opens translations.json file and returns
-        its data as a dictionary.
+# and compiles its data to a translation catalog
+def loadTranslations(version) -> Translations:
+    '''
+    Loads the translations file and returns a new translation catalog
+
+    Parameters
+    ----------
+    version : (int, int, int)
+            Version of the translations file (see getTranslationsVersion())
+
+    Returns
+    -------
+    Translations
+            The compiled translation catalog
     '''
     # Open translation.json file
     try:
-        with open('translation.json', 'r',
+        with open(TRANSLATIONS_FILE, 'r',
                   encoding='utf-8') as translationFile:
             # Load translation.json file to memory as translations object
-            translations = json.load(translationFile)
+            data = json.load(translationFile)
     except (FileNotFoundError, ValueError
             ):  # This exception means there's no translation.json file
-        translations = {}
-    # Return translations
-    return translations
+        data = {}
+    # Empty translations are ignored (the english string will be used)
+    strings = types.MappingProxyType(
+        {text: translation for text, translation in data.items()
+         if translation})
+    return Translations(
+        version=version,
+        strings=strings,
+        days=tuple(strings.get(day, day) for day in DAYS),
+        # Months start from 1
+        jmonths=('',) + tuple(strings.get(month, month)
+                              for month in JALALI_MONTHS),
+        gmonths=('',) + tuple(strings.get(month, month)
+                              for month in GREGORIAN_MONTHS))
+
+
+# This function returns the translation catalog
+# and reloads it if the translations file is changed
+def getTranslations() -> Translations:
+    '''
+    Returns the translation catalog of this process
+    (it's loaded again when the translations file changes)
+    '''
+    global translations
+    version = getTranslationsVersion()
+    catalog = translations
+    if catalog is None or catalog.version != version:
+        with translationsLock:
+            # Another thread may have loaded it already
+            catalog = translations
+            if catalog is None or catalog.version != version:
+                # Replace the whole catalog at once
+                catalog = loadTranslations(version)
+                translations = catalog
+    return catalog
 
 
 # This function will look for translation of
@@ -273,17 +697,9 @@ def tr(text: str) -> str:
     str
             mapped string to 'text' in translation.json file
     '''
-    # Get translations from translations.json file
-    # and save it to translations dictionary
-    translations = getTranslations()
-    # Return mapped string to 'text' in the translations dictionary
-    try:
-        # Return translation if it exists
-        # or return the given string if there's no translation!
-        return translations[text] if translations[text] else text
-    except KeyError:  # This exception means there's no match for given string
-        # So We'll return the given text
-        return text
+    # Return translation if it exists
+    # or return the given string if there's no translation!
+    return getTranslations().strings.get(text, text)
 
 
 class ConfigForm(FlaskForm):  # Config page form
@@ -549,12 +965,51 @@ def saveConfig(conf: [str, str]):
             a dictionary which contains the config
     '''
     # Update the global config object values to new config values
-    global cfg
+    global cfg, cfgVersion
     cfg = conf
-    # Open config file for output and erase its data
-    with open(CONFIG_FILE, 'w') as configFile:
+    # Write the new config to a temporary file and replace the config
+    # file with it (so other workers never read a half written file)
+    tempFile = '%s.%d.tmp' % (CONFIG_FILE, os.getpid())
+    with open(tempFile, 'w') as configFile:
         # Save new config
         json.dump(cfg, configFile, indent=4, sort_keys=True)
+    os.replace(tempFile, CONFIG_FILE)
+    # We've already loaded this version
+    cfgVersion = getConfigVersion(True)
+    # Dates which are formatted using the old config are outdated
+    formatCalendarDateTime.cache_clear()
+    # Responses which are generated using the old config are outdated
+    bumpGenerations('config')
+
+
+# This function returns the version of the config file
+def getConfigVersion(forceCheck: bool = False):
+    '''
+    Returns the modification time, inode and size of the config file
+    (the config file is checked once in each request)
+
+    Parameters
+    ----------
+    forceCheck : bool
+            Check the config file again even if it's already checked
+            in this request
+
+    Returns
+    -------
+    (int, int, int)
+            Modification time, inode and size of the config file
+            or None if the config file doesn't exist
+    '''
+    # We'll save the version in the request environment
+    environ = request.environ if has_request_context() else {}
+    if forceCheck or 'blog.config_version' not in environ:
+        try:
+            stat = os.stat(CONFIG_FILE)
+            environ['blog.config_version'] = (stat.st_mtime_ns,
+                                              stat.st_ino, stat.st_size)
+        except FileNotFoundError:
+            environ['blog.config_version'] = None
+    return environ['blog.config_version']
 
 
 # This function will return a copy of the global config object
@@ -587,28 +1042,59 @@ def getConfig(forceReload: bool = False) -> [str, str]:
             a copy of the global config object
     '''
     # Use the global config object
-    global cfg
+    global cfg, cfgVersion
+    # Check if config file exists
+    # (if application is already installed and configured)
+    version = getConfigVersion()
     # Load config file to the memory as config object
-    # if it's not loaded yet
-    if not any(cfg) or forceReload:
-        # Check if config file exists
-        # (if application is already installed and configured)
-        try:
-            with open(CONFIG_FILE, 'r') as configFile:
-                cfg = json.load(configFile)
-        except FileNotFoundError:  # This exception means that
-            # the program is not installed and configured yet!
-            # So we'll call install() to make the config and
-            # database files and redirect user to config page
-            cfg = install()
+    # if it's not loaded yet or it's changed by another worker
+    if version is not None and \
+            (not any(cfg) or forceReload or version != cfgVersion):
+        with open(CONFIG_FILE, 'r') as configFile:
+            cfg = json.load(configFile)
+        cfgVersion = version
+        # Dates which are formatted using the old config are outdated
+        formatCalendarDateTime.cache_clear()
+    elif version is None and (not any(cfg) or forceReload):
+        # This means that the program is not installed and
+        # configured yet! So we'll call install() to make the config
+        # and database files and redirect user to config page
+        cfg = install()
     # Return the config object
     return cfg
 
 
+# Tokens of the post content which prcText() replaces with HTML tags
+# (links, hashtags, new lines and the markers of the search matches),
+# the rest of the text is escaped
+# (the markers may be inside the links and hashtags of the search results)
+TEXT_TOKENS = re.compile(
+    r"(?P<link>\x02?https?\x03?://[^\s<>'\"]*[^\s<>'\".,;:!?)\]\x02])"
+    r"|#(?P<tag>\x02?\w[\w\x02\x03]*)"
+    r"|(?P<newline>\r?\n)"
+    r"|(?P<mark>[\x02\x03])")
+# Markers of the matching words in the search results (see renderPage())
+MARKS = {'\x02': '<mark>', '\x03': '</mark>'}
+# Removes the markers (from the addresses of the links and hashtags)
+NO_MARKS = str.maketrans('', '', ''.join(MARKS))
+
+
+# This function escapes a text and replaces its markers with <mark> tags
+def markText(text: str) -> str:
+    '''
+    Escapes 'text' and replaces the markers of the search matches
+    (\\x02 and \\x03) with <mark> and </mark>
+    '''
+    text = str(escape(text))
+    for marker, tag in MARKS.items():
+        text = text.replace(marker, tag)
+    return text
+
+
 # This function replaces all hashtags in 'rawText' with linked hashtags
 # 'url' must only contain domain name and script path
 # (send request.script_root as its value!)
-def prcText(rawText: str, url: str) -> str:
+def prcText(rawText: str, url: str, highlight: bool = False) -> str:
     '''
     Replaces all hashtags in the 'rawText' with linked hashtags 
     (Adds html <a> tag to all hashtags in the 'rawText' 
@@ -618,6 +1104,8 @@ def prcText(rawText: str, url: str) -> str:
     "hello 
     <a href='https://www.site.com/blog/?tag=dear' class='hashtag'>#dear</a>
     user!"
+    It also links the web addresses, replaces new lines with <br>
+    and escapes the rest of the text (in a single pass over the text)
 
     Parameters
     ----------
@@ -629,6 +1117,10 @@ def prcText(rawText: str, url: str) -> str:
             (for example : https://www.site.com/blog)
             Send request.script_root as its value
             if you don't know how to use it
+    highlight : bool
+            Replace the markers of the search matches (\\x02 and \\x03
+            which snippet() puts around the matches) with <mark> tags
+            (they're removed if it's False)
 
     Returns
     -------
@@ -636,32 +1128,184 @@ def prcText(rawText: str, url: str) -> str:
             a string containing 'rawText' content but hashtags 
             are replaced with linked (<a href="hashtag page">) hashtags!
     '''
-    # Find all hashtags using regex
-    hashTags = re.findall(r"#(\w+)", rawText)
-    # Replace each hashtag with a link to that hashtag
-    for hashTag in set(hashTags):
-        rawText = rawText.replace(
-            '#' + hashTag, "<a href='" + url + "/?tag=" + hashTag +
-            "' class='hashtag'>#" + hashTag + "</a>")
-
-    # Replace new lines with html <br> tag!
-    rawText = rawText.replace('\n', '<br>')
+    # Markers are only allowed in the search results
+    if not highlight:
+        rawText = rawText.translate(NO_MARKS)
+    # Parts of the produced string
+    parts = []
+    # End of the last token
+    position = 0
+    for token in TEXT_TOKENS.finditer(rawText):
+        # Escape the text before the token
+        parts.append(str(escape(rawText[position:token.start()])))
+        position = token.end()
+        # Replace each hashtag with a link to that hashtag
+        # (the matches are only marked in the text of the links)
+        if token.group('tag') is not None:
+            tag = token.group('tag')
+            parts.append("<a href='" + url + "/?tag=" +
+                         tag.translate(NO_MARKS) + "' class='hashtag'>#" +
+                         markText(tag) + "</a>")
+        # Link the web addresses
+        elif token.group('link') is not None:
+            link = token.group('link')
+            parts.append("<a href='" + str(escape(link.translate(NO_MARKS))) +
+                         "' rel='nofollow'>" + markText(link) + "</a>")
+        # Replace the markers of the search matches with <mark> tags
+        elif token.group('mark') is not None:
+            parts.append(MARKS[token.group('mark')])
+        # Replace new lines with html <br> tag!
+        else:
+            parts.append('<br>')
+    parts.append(str(escape(rawText[position:])))
     # Return the produced string to appear on the requested page
-    return Markup(rawText)
+    return Markup(''.join(parts))
+
+
+# Version of the rules which renderContent() uses, increase it whenever
+# the rules change and all the posts will be rendered again
+RENDERER_VERSION = 2
+
+
+# This function renders the post content
+def renderContent(content: str) -> (str, str):
+    '''
+    Renders the post content and its first 512 characters as HTML
+    (links are relative to the blog's root address,
+    use withScriptRoot() to make them absolute)
+
+    Parameters
+    ----------
+    content : str
+            The post content
+
+    Returns
+    -------
+    (str, str)
+            The post content as HTML and the first 512 characters of
+            the post content as HTML (or an empty string if the content
+            is shorter than 512 characters)
+    '''
+    html = str(prcText(content, ''))
+    excerpt = ''
+    # If the content length is greater than 512 characters then
+    # we'll just show the first 512 characters of the post content
+    # on the main page
+    if len(content) > 512:
+        # Get first 512 characters of the post content
+        excerpt = content[0:512]
+        # remove the last word in the first 512 characters of
+        # the post content because it may be an incomplete word
+        excerpt = excerpt[0:excerpt.rfind(' ')]
+        # Markup Hashtags
+        excerpt = str(prcText(excerpt, '')) + '...'
+    return html, excerpt
+
+
+# This function adds the blog's root address to the rendered links
+def withScriptRoot(html: str, url: str) -> Markup:
+    '''
+    Adds the blog's root address to the links of a rendered content
+
+    Parameters
+    ----------
+    html : str
+            Content rendered by renderContent()
+    url : str
+            Address of our script (send request.script_root as its value)
+
+    Returns
+    -------
+    Markup
+            The rendered content with absolute links
+    '''
+    if url != '':
+        html = html.replace("href='/", "href='" + url + '/')
+    return Markup(html)
+
+
+# This function renders the posts which are rendered by an older renderer
+def renderPosts() -> int:
+    '''
+    Renders the posts which are not rendered by the current
+    version of renderContent() (100 posts in each transaction)
+
+    Returns
+    -------
+    int
+            Number of the rendered posts
+    '''
+    count = 0
+    while True:
+        results = db.session.query(dbpost.postid, dbpost.content) \
+            .filter(dbpost.renderer != RENDERER_VERSION).limit(100).all()
+        if not results:
+            return count
+        rendered = []
+        for result in results:
+            html, excerpt = renderContent(result.content)
+            rendered.append({'id': result.postid, 'rendered': html,
+                             'summary': excerpt})
+        db.session.execute(
+            dbpost.__table__.update() \
+                .where(dbpost.postid == db.bindparam('id')) \
+                .values(html=db.bindparam('rendered'),
+                        excerpt=db.bindparam('summary'),
+                        renderer=RENDERER_VERSION),
+            rendered)
+        db.session.commit()
+        bumpGenerations('posts')
+        count = count + len(results)
+
+
+# This function will find the first and last moment of a month
+def monthRange(year: int, month: int, calendarType: str) -> (int, int):
+    '''
+    Returns the timestamps of the beginning of a month and the next month
+    (the month may be a Jalali or Gregorian month)
+
+    Parameters
+    ----------
+    year : int
+            Year
+    month : int
+            Month (1 to 12)
+    calendarType : str
+            'Jalali' or 'Gregorian'
+
+    Returns
+    -------
+    (int, int)
+            timestamp of the first day of the month
+            and timestamp of the first day of the next month
+    '''
+    # The end is counted from the number of days of the month (the first
+    # day of the next month can't be made for the last month of MAXYEAR)
+    if calendarType == 'Jalali':
+        first = jdatetime.date(year, month, 1)
+        days = jdatetime.j_days_in_month[month - 1] + \
+            (month == 12 and first.isleap())
+        first = first.togregorian()
+    else:
+        first = datetime.date(year, month, 1)
+        days = calendar.monthrange(year, month)[1]
+    start = calendar.timegm(first.timetuple())
+    return start, start + days * 86400
 
 
 # This function will format date/time
-@cache.memoize()
-def formatDateTime(strDateTime: str, strFormat: str) -> str:
+def formatDateTime(timestamp: int, strFormat: str) -> str:
     '''
-    Formats the 'strDateTime' using the 'strFormat' value
+    Formats the 'timestamp' using the 'strFormat' value
     Also converts the gregorian Date/Time to jalali Date/Time 
+    (results are cached in this process, see formatCalendarDateTime())
 
     Parameters
     ----------
-    strDateTime : str
-            a string which must contain a Date/Time 
-            in '%Y-%m-%d %H:%M:%S' format
+    timestamp : int
+            Date/Time as seconds since 1970-01-01 00:00:00
+            (a string which contains a Date/Time
+            in '%Y-%m-%d %H:%M:%S' format is also accepted)
     strFormat : str
             a string which must contain a format string 
             like '%Y-%m-%d %H:%M:%S'
@@ -672,69 +1316,66 @@ def formatDateTime(strDateTime: str, strFormat: str) -> str:
             a string which contains a date/time equal to 
             'strDateTime' but formatted like 'strFormat'
     '''
+    # Convert the date/time string to timestamp
+    if isinstance(timestamp, str):
+        timestamp = toTimestamp(timestamp)
     # Get settings in order to check if Jalali Calendar is enabled or not later
-    config = getConfig()
+    return formatCalendarDateTime(timestamp, strFormat,
+                                  getConfig()['calendar'],
+                                  getTranslations().version)
+
+
+# This function formats date/time using a specific calendar
+# Results are kept in a bounded LRU cache of this process
+# (cleared whenever the config changes)
+@functools.lru_cache(maxsize=app.config['DATETIME_CACHE_SIZE'])
+def formatCalendarDateTime(timestamp: int, strFormat: str, calendarType: str,
+                           version) -> str:
+    '''
+    Formats the 'timestamp' using the 'strFormat' value and
+    the 'calendarType' calendar (use formatDateTime() instead)
+
+    Parameters
+    ----------
+    timestamp : int
+            Date/Time as seconds since 1970-01-01 00:00:00
+    strFormat : str
+            a string which must contain a format string
+            like '%Y-%m-%d %H:%M:%S'
+    calendarType : str
+            'Jalali' or 'Gregorian'
+    version : (int, int, int)
+            Version of the translation catalog which is used for
+            the names of the months and days
+
+    Returns
+    -------
+    str
+            Formatted date/time
+    '''
     # This is where we keep the result!
     result = ''
-    # Names of the days of the week
-    days = {
-        0: tr('Monday'),
-        1: tr('Tuesday'),
-        2: tr('Wednesday'),
-        3: tr('Thursday'),
-        4: tr('Friday'),
-        5: tr('Saturday'),
-        6: tr('Sunday')
-    }
-    # Convert strDateTime to a date/time object
-    gdt = datetime.datetime.strptime(strDateTime, '%Y-%m-%d %H:%M:%S')
+    # Names of the days and months
+    catalog = getTranslations()
+    # Convert timestamp to a date/time object
+    gdt = datetime.datetime.utcfromtimestamp(timestamp)
     jdt = jdatetime.GregorianToJalali(gdt.year, gdt.month, gdt.day)
     # If Jalali Calendar is enabled!
-    if config['calendar'] == 'Jalali':
+    if calendarType == 'Jalali':
         # We'll use the Jalali Calendar
-        # Jalali months
-        jmonths = {
-            1: tr('Farvardin'),
-            2: tr('Ordibehesht'),
-            3: tr('Khordad'),
-            4: tr('Tir'),
-            5: tr('Mordad'),
-            6: tr('Shahrivar'),
-            7: tr('Mehr'),
-            8: tr('Aban'),
-            9: tr('Azar'),
-            10: tr('Dey'),
-            11: tr('Bahman'),
-            12: tr('Esfand')
-        }
         result = strFormat.replace('%Y', str(jdt.jyear))
         result = result.replace('%m', str(jdt.jmonth))
-        result = result.replace('%B', jmonths[jdt.jmonth])
+        result = result.replace('%B', catalog.jmonths[jdt.jmonth])
         result = result.replace('%d', str(jdt.jday))
     # If Jalali Calendar is disabled
-    elif config['calendar'] == 'Gregorian':
+    elif calendarType == 'Gregorian':
         # We'll use the Gregorian Calendar
-        # Gregorian months
-        gmonths = {
-            1: tr('January'),
-            2: tr('February'),
-            3: tr('March'),
-            4: tr('April'),
-            5: tr('May'),
-            6: tr('June'),
-            7: tr('July'),
-            8: tr('August'),
-            9: tr('September'),
-            10: tr('October'),
-            11: tr('November'),
-            12: tr('December')
-        }
         result = strFormat.replace('%Y', str(gdt.year))
         result = result.replace('%m', str(gdt.month))
-        result = result.replace('%B', gmonths[gdt.month])
+        result = result.replace('%B', catalog.gmonths[gdt.month])
         result = result.replace('%d', str(gdt.day))
     # End If
-    result = result.replace('%A', days[gdt.weekday()])
+    result = result.replace('%A', catalog.days[gdt.weekday()])
     result = result.replace('%H', str(gdt.hour))
     result = result.replace('%M', str(gdt.minute))
     result = result.replace('%S', str(gdt.second))
@@ -743,40 +1384,521 @@ def formatDateTime(strDateTime: str, strFormat: str) -> str:
     return result
 
 
-# After deleting or editing a post we'll call this function
-# to delete or reduce the frequncy of removed hashtags
-def deleteTag(hashTag: str):
+# Maximum number of the hashtags in each statement
+# (sqlite versions older than 3.32 allow 999 variables in each statement)
+TAGS_PER_STATEMENT = 500
+
+
+# After saving, editing or deleting a post we'll call this function
+# to update the hashtags which are added to or removed from the post
+def updateTags(postid: int, oldContent: str, newContent: str):
     '''
-    Checks a hashtag's frequency in the database
-    And performs the following tasks:
-    If it's greater than 1 then decrease it by 1
-    Else if it's less or equal to 1 then remove the hashtag from the database
+    Compares the hashtags of the old and new content of a post and
+    performs the following tasks for the hashtags which are changed
+    (hashtags that exist in both old and new content won't be touched):
+    Removed hashtags : decrease their frequency by 1, unlink them from
+    the post and remove them if they're not used in any other post
+    Added hashtags : create them or increase their frequency by 1
+    and link them to the post
+    Changes will be saved in the current transaction (it doesn't commit)
+
+    Parameters
+    ----------
+    postid : int
+            Post ID
+    oldContent : str
+            Old content of the post (empty string for new posts)
+    newContent : str
+            New content of the post (empty string for deleted posts)
+    '''
+    # Find the hashtags of the old and new content
+    oldTags = set(re.findall(r"#(\w+)", oldContent))
+    newTags = set(re.findall(r"#(\w+)", newContent))
+    removedTags = sorted(oldTags - newTags)
+    addedTags = sorted(newTags - oldTags)
+    for i in range(0, len(removedTags), TAGS_PER_STATEMENT):
+        keywords = removedTags[i:i + TAGS_PER_STATEMENT]
+        # Unlink the removed hashtags from the post
+        dbposttag.query.filter(
+            dbposttag.postid == postid,
+            dbposttag.tagid.in_(db.select([dbtag.tagid]).where(
+                dbtag.keyword.in_(keywords)))).delete(
+                    synchronize_session=False)
+        # Reduce the frequency of the removed hashtags
+        dbtag.query.filter(dbtag.keyword.in_(keywords)).update(
+            {dbtag.frequency: dbtag.frequency - 1},
+            synchronize_session=False)
+        # Delete the hashtags which are not used in any post
+        dbtag.query.filter(dbtag.keyword.in_(keywords),
+                           dbtag.frequency <= 0).delete(
+                               synchronize_session=False)
+    if addedTags:
+        # Create the new hashtags (frequency is 1 and nobody clicked on
+        # them yet so popularity is 0) or increase the frequency of
+        # the existing hashtags in a single statement
+        db.session.execute(
+            'INSERT INTO dbtag (keyword, frequency, popularity) ' + \
+            'VALUES (:keyword, 1, 0) ON CONFLICT (keyword) ' + \
+            'DO UPDATE SET frequency = frequency + 1',
+            [{'keyword': keyword} for keyword in addedTags])
+        # Add them to the keywords of the existing hashtags
+        with tagLock:
+            tagKeywords.update(addedTags)
+    for i in range(0, len(addedTags), TAGS_PER_STATEMENT):
+        # Link the added hashtags to the post
+        db.session.execute(dbposttag.__table__.insert().from_select(
+            ['postid', 'tagid'],
+            db.select([db.literal(postid), dbtag.tagid]).where(
+                dbtag.keyword.in_(addedTags[i:i + TAGS_PER_STATEMENT]))))
+
+
+# Clicks on hashtags which are not saved to the database yet
+# ({keyword: number of clicks}, each worker process has its own buffer)
+tagClicks = {}
+# Total number of the clicks in the buffer
+tagClicksCount = 0
+# Last time that we saved the clicks (time.monotonic())
+tagClicksFlushed = time.monotonic()
+# Keywords of the existing hashtags, we'll use this set to ignore
+# the clicks on hashtags that don't exist without querying the database
+tagKeywords = set()
+# Last time that we loaded the keywords (time.monotonic())
+tagKeywordsLoaded = None
+# Lock of the clicks buffer and the keywords set
+tagLock = threading.Lock()
+
+
+# db.session will call this function after saving a new hashtag
+@event.listens_for(dbtag, 'after_insert')
+def addTagKeyword(mapper, connection, target):
+    '''
+    Adds a new hashtag to the keywords of the existing hashtags
+    '''
+    with tagLock:
+        tagKeywords.add(target.keyword)
+
+
+# This function checks if a hashtag exists
+def isKnownTag(hashTag: str) -> bool:
+    '''
+    Checks if a hashtag exists using the keywords of the existing
+    hashtags which are loaded from the database every
+    TAG_KEYWORDS_TIMEOUT seconds (so it doesn't query the database)
 
     Parameters
     ----------
     hashtag : str
-            a string which must contain only a hashtag without # 
-            (for example : 'blog')
-    '''
-    # Find the hashtag in database using its name
-    tag = dbtag.query.filter(dbtag.keyword == hashTag)
-    # Check if no hashtag is found
-    if tag.count() == 0:
-        # Return if no hashtag is found!
+            a string which must contain only a hashtag without #
+
+    Returns
+    -------
+    bool
+            True if the hashtag exists
+    '''
+    global tagKeywords, tagKeywordsLoaded
+    now = time.monotonic()
+    # Reload the keywords (hashtags may be added by other workers)
+    if tagKeywordsLoaded is None or \
+            now - tagKeywordsLoaded >= app.config['TAG_KEYWORDS_TIMEOUT']:
+        keywords = {keyword for keyword, in db.session.query(dbtag.keyword)}
+        with tagLock:
+            tagKeywords = keywords
+            tagKeywordsLoaded = now
+    return hashTag in tagKeywords
+
+
+# This function saves the clicks on hashtags to the database
+def flushTagClicks():
+    '''
+    Increases the popularity of the clicked hashtags
+    by the number of their clicks using a single statement
+    and empties the clicks buffer
+    '''
+    global tagClicksCount, tagClicksFlushed
+    with tagLock:
+        clicks = dict(tagClicks)
+        tagClicks.clear()
+        tagClicksCount = 0
+        tagClicksFlushed = time.monotonic()
+    if not clicks:
         return
-    # If we found a hashtag
-    else:
-        # Reduce hashtag frequncy if it's more than 1 or delete the hashtag
-        # if it's not being used in any post (frequncy <= 1)
-        if tag.first().frequency > 1:
-            # Reduce the hashtag frequncy because it's used in another post
-            tag.first().frequency = tag.first().frequency - 1
-        else:
-            # Delete the hashtag from the database
-            # because it's not used in any post
-            tag.delete()
+    try:
+        db.session.execute(
+            dbtag.__table__.update() \
+                .where(dbtag.keyword == db.bindparam('tag')) \
+                .values(popularity=dbtag.popularity + db.bindparam('clicks')),
+            [{'tag': tag, 'clicks': count} for tag, count in clicks.items()])
+        db.session.commit()
+    except Exception as e:
+        # Popularity is not that important! we'll just log the error
+        db.session.rollback()
+        logger.error('Saving hashtag clicks failed - ' + repr(e))
+
+
+# This function counts the clicks on hashtags
+def countTagClick(hashTag: str):
+    '''
+    Adds a click on a hashtag to the clicks buffer (if the hashtag exists)
+    and saves the buffer to the database every TAG_CLICKS_FLUSH_INTERVAL
+    seconds or every TAG_CLICKS_FLUSH_COUNT clicks
+
+    Parameters
+    ----------
+    hashtag : str
+            a string which must contain only a hashtag without #
+    '''
+    global tagClicksCount
+    # Ignore the hashtags that don't exist
+    if hashTag == '' or not isKnownTag(hashTag):
+        return
+    with tagLock:
+        tagClicks[hashTag] = tagClicks.get(hashTag, 0) + 1
+        tagClicksCount = tagClicksCount + 1
+        flush = tagClicksCount >= app.config['TAG_CLICKS_FLUSH_COUNT'] or \
+            time.monotonic() - tagClicksFlushed >= \
+                app.config['TAG_CLICKS_FLUSH_INTERVAL']
+    if flush:
+        flushTagClicks()
+
+
+# Save the remaining clicks when the worker process exits
+@atexit.register
+def saveTagClicks():
+    '''
+    Saves the clicks buffer to the database
+    '''
+    if tagClicks:
+        with app.app_context():
+            flushTagClicks()
+
+
+# This function fills the posts <-> tags table using the posts content
+# (for posts which were saved before adding the posts <-> tags table)
+def indexPostTags():
+    '''
+    Finds the hashtags of all the posts and links each post to
+    its hashtags in the posts <-> tags table, creates the missing
+    hashtags and recounts the frequency of all the hashtags
+    '''
+    # Create the posts <-> tags table if it doesn't exist
+    dbposttag.__table__.create(db.engine, checkfirst=True)
+    # Existing hashtags and links
+    tags = {tag.keyword: tag.tagid for tag in
+            db.session.query(dbtag.keyword, dbtag.tagid)}
+    links = set(db.session.query(dbposttag.postid, dbposttag.tagid))
+    newlinks = []
+    # Only load the columns that we need
+    for postid, content in db.session.query(dbpost.postid, dbpost.content):
+        for hashTag in set(re.findall(r"#(\w+)", content)):
+            # Create the hashtag if it doesn't exist
+            if hashTag not in tags:
+                tag = dbtag(keyword=hashTag, frequency=0, popularity=0)
+                db.session.add(tag)
+                db.session.flush()
+                tags[hashTag] = tag.tagid
+            if (postid, tags[hashTag]) not in links:
+                newlinks.append({'postid': postid, 'tagid': tags[hashTag]})
+    # Save all the new links at once
+    if newlinks:
+        db.session.execute(dbposttag.__table__.insert(), newlinks)
+    # Recount the frequency of the hashtags using the new links
+    # and remove the hashtags which are not used in any post
+    db.session.query(dbtag).update(
+        {dbtag.frequency: db.select([db.func.count()]) \
+            .where(dbposttag.tagid == dbtag.tagid).as_scalar()},
+        synchronize_session=False)
+    dbtag.query.filter(dbtag.frequency == 0).delete()
+    # Save changes to the database
+    db.session.commit()
+    bumpGenerations('tags')
+    return len(newlinks)
+
+
+# This function adds a new column to an existing table
+def addColumn(attribute):
+    '''
+    Adds a column to its table if it doesn't exist in the database
+    (Used for upgrading the tables created before adding the column)
+
+    Parameters
+    ----------
+    attribute : Column
+            Model attribute of the column (for example : dbpost.pinned)
+    '''
+    column = attribute.property.columns[0]
+    columns = db.inspect(db.engine).get_columns(column.table.name)
+    if column.name not in [item['name'] for item in columns]:
+        db.session.execute('ALTER TABLE %s ADD COLUMN %s %s NOT NULL ' \
+            "DEFAULT '%s'" % (column.table.name, column.name,
+                              column.type.compile(db.engine.dialect),
+                              column.server_default.arg.replace("'", "''")))
+        db.session.commit()
+
+
+# This function recounts the number of comments of each post
+def recountComments():
+    '''
+    Recounts the number of comments and approved comments of
+    all the posts using the comments table
+    (Adds the approved comments column to the posts table
+    if it's created before adding this column)
+    '''
+    # Add the approved comments column if it doesn't exist
+    addColumn(dbpost.approved_comments)
+    # Count the comments of each post in a single statement
+    count = db.select([db.func.count()]).where(dbcomment.pid == dbpost.postid)
+    db.session.query(dbpost).update(
+        {dbpost.comments: count.as_scalar(),
+         dbpost.approved_comments: count.where(dbcomment.status >= 2) \
+            .as_scalar()},
+        synchronize_session=False)
     # Save changes to the database
     db.session.commit()
+    bumpGenerations('comments')
+
+
+# This function loads the comments which are shown to users
+def loadComments(condition, dtformat: str) -> list:
+    '''
+    Loads the comments which match 'condition' (only the columns that
+    we show to users) and formats their date/time
+
+    Parameters
+    ----------
+    condition :
+            SQLAlchemy filter which selects the comments
+    dtformat : str
+            Date/Time format
+
+    Returns
+    -------
+    list
+            CommentView objects (oldest comment first)
+    '''
+    results = db.session.query(
+        dbcomment.cmtid, dbcomment.pid, dbcomment.content,
+        dbcomment.timestamp, dbcomment.name, dbcomment.website,
+        dbcomment.emailaddr, dbcomment.status) \
+        .filter(condition).order_by(dbcomment.cmtid).all()
+    # Format date/time using the 'formatDateTime' function
+    # rest is the same without any modification!
+    return [CommentView(result.cmtid, result.pid, result.content,
+                        formatDateTime(result.timestamp, dtformat),
+                        result.name, result.website, result.emailaddr,
+                        result.status) for result in results]
+
+
+# This function marks the comments as seen by admin
+def markCommentsSeen(condition, lastid: int):
+    '''
+    Removes the unseen status of the comments using a single statement
+    and saves changes to the database
+
+    Parameters
+    ----------
+    condition :
+            SQLAlchemy filter which selects the comments
+    lastid : int
+            Id of the last comment which is shown to admin
+            (newer comments remain unseen)
+    '''
+    # Update the unseen comments only
+    db.session.query(dbcomment).filter(
+        condition, dbcomment.cmtid <= lastid,
+        dbcomment.status.op('&')(1) == 0) \
+        .update({dbcomment.status: dbcomment.status.op('|')(1)},
+                synchronize_session=False)
+    # Save changes to the database
+    db.session.commit()
+
+
+# This function creates the indexes which don't exist in the database
+def createIndexes(*names):
+    '''
+    Creates the given indexes (defined in the models)
+    if they don't exist in the database and updates the statistics
+    which sqlite uses for choosing the indexes
+
+    Parameters
+    ----------
+    names : str
+            Names of the indexes
+    '''
+    for model in (dbpost, dbcomment, dbtag, dbposttag):
+        existing = [index['name'] for index in db.inspect(db.engine) \
+            .get_indexes(model.__tablename__)]
+        for index in model.__table__.indexes:
+            if index.name in names and index.name not in existing:
+                index.create(db.engine)
+    db.session.execute('ANALYZE')
+    db.session.commit()
+
+
+# This function fills the pinned column and creates the missing indexes
+def indexPosts():
+    '''
+    Adds the pinned column to the posts table, fills it using the
+    post flags and creates the indexes which are used by the main page,
+    the sidebar and the comment moderation page
+    '''
+    # Add the pinned column and fill it using the flags
+    addColumn(dbpost.pinned)
+    dbpost.query.update(
+        {dbpost.pinned: db.case(((dbpost.flags.op('&')(2) == 2, 1), ),
+                                else_=0)},
+        synchronize_session=False)
+    db.session.commit()
+    # Create the missing indexes
+    createIndexes('ix_dbpost_pinned_postid',
+                  'ix_dbpost_pinned_comments_postid',
+                  'ix_dbpost_category_pinned_postid',
+                  'ix_dbcomment_postid_status',
+                  'ix_dbcomment_status_commentid',
+                  'ix_dbtag_frequency',
+                  'ix_dbtag_popularity')
+
+
+# This function fills the timestamp columns using the date/time strings
+def indexDateTimes():
+    '''
+    Adds the timestamp columns to the posts and comments tables,
+    fills them using the date/time strings and creates their indexes
+    '''
+    for model in (dbpost, dbcomment):
+        addColumn(model.timestamp)
+        # sqlite's strftime('%s') doesn't convert the timezone
+        # so it's the same as toTimestamp()
+        model.query.update(
+            {model.timestamp: db.cast(
+                db.func.strftime('%s', model.gdatetime), db.Integer)},
+            synchronize_session=False)
+    db.session.commit()
+    createIndexes('ix_dbpost_timestamp', 'ix_dbcomment_timestamp')
+
+
+# This function adds the rendered content columns to the posts table
+def indexRenderedContent():
+    '''
+    Adds the html, excerpt and renderer columns to the posts table
+    and renders all the posts
+    '''
+    addColumn(dbpost.html)
+    addColumn(dbpost.excerpt)
+    addColumn(dbpost.renderer)
+    db.session.commit()
+    renderPosts()
+
+
+# Database migrations, each migration upgrades the database to the next
+# version (database version is stored in sqlite's user_version pragma)
+# All migrations can safely run again if an upgrade is interrupted
+MIGRATIONS = (
+    rebuildSearchIndex,  # Version 1 : Full-text search index
+    indexPostTags,  # Version 2 : Posts <-> tags table
+    recountComments,  # Version 3 : Number of approved comments
+    indexPosts,  # Version 4 : Pinned column and indexes
+    indexDateTimes,  # Version 5 : Timestamp columns
+    indexRenderedContent,  # Version 6 : Rendered content columns
+)
+
+
+# sqlite's user_version pragma contains the number of applied migrations
+# and the version of the renderer which has rendered the posts
+# (user_version = renderer version * VERSION_STEP + database version)
+VERSION_STEP = 1000
+
+
+# This function returns the version of the database
+def getDatabaseVersion() -> int:
+    '''
+    Returns the version of the database (number of applied migrations)
+    '''
+    return db.session.execute('PRAGMA user_version').scalar() % VERSION_STEP
+
+
+# This function returns the version of the renderer which has rendered
+# the posts of the database
+def getRendererVersion() -> int:
+    '''
+    Returns the RENDERER_VERSION which is saved in the database
+    (0 if the posts are never rendered by upgradeDatabase())
+    '''
+    return db.session.execute('PRAGMA user_version').scalar() // VERSION_STEP
+
+
+# This function saves the version of the database
+def setDatabaseVersion(version: int, renderer: int):
+    '''
+    Saves the database version (number of applied migrations) and
+    the renderer version in sqlite's user_version pragma
+    (changes are saved when the transaction is committed)
+    '''
+    db.session.execute('PRAGMA user_version = %d' %
+                       (renderer * VERSION_STEP + version))
+
+
+# This function will mark a database as up to date
+# db.create_all() calls it after creating the tables of a new database
+@event.listens_for(db.metadata, 'after_create')
+def stampDatabase(target, connection, tables=(), **kw):
+    '''
+    Sets the version of new databases to the latest version
+    (Tables created by db.create_all() don't need any migration)
+    '''
+    if dbpost.__table__ in tables:
+        connection.execute('PRAGMA user_version = %d' %
+                           (RENDERER_VERSION * VERSION_STEP + len(MIGRATIONS)))
+
+
+# This function upgrades the database to the latest version
+def upgradeDatabase() -> int:
+    '''
+    Runs the migrations which are not applied to the database yet
+    and renders the posts again if the renderer has changed
+
+    Returns
+    -------
+    int
+            Number of applied migrations
+    '''
+    # There's nothing to upgrade if the database is not created yet
+    if not db.engine.has_table(dbpost.__tablename__):
+        return 0
+    version = getDatabaseVersion()
+    migrations = MIGRATIONS[version:]
+    for migration in migrations:
+        logger.info('Upgrading database to version %d (%s)' %
+                    (version + 1, migration.__name__))
+        migration()
+        version = version + 1
+        # Save the new version after each migration
+        setDatabaseVersion(version, getRendererVersion())
+        db.session.commit()
+    # Only the first process which gets the write lock renders the posts
+    # again if the renderer has changed (it saves the new renderer version
+    # and releases the lock before rendering them so the other processes
+    # won't render them and aren't blocked)
+    # Run 'flask render-posts' if the rendering is interrupted
+    db.session.execute('BEGIN IMMEDIATE')
+    saved = renderer = getRendererVersion()
+    if renderer == 0:
+        # The renderer version isn't saved in the older databases
+        # (posts may be already rendered by 'flask render-posts')
+        renderer = db.session.query(db.func.max(dbpost.renderer)).scalar()
+        if renderer is None:  # There's no post
+            renderer = RENDERER_VERSION
+    if saved != RENDERER_VERSION:
+        setDatabaseVersion(version, RENDERER_VERSION)
+    db.session.commit()
+    rendered = 0
+    if renderer != RENDERER_VERSION:
+        logger.info('Rendering the posts using renderer version %d' %
+                    RENDERER_VERSION)
+        rendered = renderPosts()
+    # Cached responses may be generated using the old database
+    if migrations or rendered:
+        bumpGenerations(*GENERATIONS)
+    return len(migrations)
 
 
 # We'll use this decorator before any function
@@ -789,14 +1911,14 @@ def authentication_required(func):
     if user doesn't have admin privileges then 
     we'll continue serving them as a user and not admin
     Use this decorator before any function 
-    that requires to check session['logged_in'] value.
+    that requires to check g.admin value.
     '''
     @functools.wraps(func)
     def authenticate(*args, **kwargs):
-        # If user didn't login yet then
-        # we'll save (logged_in = False) for his session!
-        if not 'logged_in' in session:
-            session['logged_in'] = False
+        # If user didn't login yet then they're not admin
+        # (the session is only read so visitors won't get a cookie
+        # and their responses can be cached by proxies)
+        g.admin = session.get('logged_in', False) == True
         return func(*args, **kwargs)
 
     return authenticate
@@ -816,7 +1938,7 @@ def login_required(func):
     @authentication_required
     def checkPrivileges(*args, **kwargs):
         # If 'logged_in' is False then user has no admin privileges
-        if session['logged_in'] == False:
+        if not g.admin:
             # Render error page 403 and return error code 403 'Forbidden'
             return render_template('403.html'), 403
         return func(*args, **kwargs)
@@ -824,17 +1946,164 @@ def login_required(func):
     return checkPrivileges
 
 
+# We'll use this decorator (after authentication_required) before
+# the public pages to answer the conditional requests of the browsers
+# and proxies without running any query or rendering any template
+def conditional(*names, popularTags: bool = False):
+    '''
+    A decorator which adds ETag and Last-Modified headers to the
+    visitors' responses and returns 304 'Not Modified' if the client
+    already has the latest version of the page
+    (admins and the visitors who have flashed messages get
+    their own pages so they're not cached)
+
+    Parameters
+    ----------
+    names : str
+            Names of the contents which are shown in the page
+            (see GENERATIONS)
+    popularTags : bool
+            The page shows the most popular hashtags
+            (they're updated every POPULAR_TAGS_TIMEOUT seconds)
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def respond(*args, **kwargs):
+            if g.admin or request.method != 'GET' or '_flashes' in session:
+                return func(*args, **kwargs)
+            # Generations are the times of the last changes (in nanoseconds)
+            generations = [int(generation) for generation in
+                           getGenerations(*names).split('.')]
+            if popularTags:
+                timeout = app.config['POPULAR_TAGS_TIMEOUT']
+                generations.append(int(time.time() // timeout * timeout
+                                       * 1000000000))
+            # The config, translations and static files may change
+            # without changing the generations
+            etag = hashlib.sha1(json.dumps(
+                [request.full_path, generations, getConfigVersion(),
+                 getTranslations().version,
+                 sorted(getStaticAssets().values())]).encode('utf-8')) \
+                .hexdigest()
+            lastModified = datetime.datetime.utcfromtimestamp(
+                max(generations) // 1000000000)
+            # The client has the latest version of the page
+            if request.if_none_match:
+                notModified = request.if_none_match.contains(etag)
+            else:
+                notModified = request.if_modified_since is not None and \
+                    request.if_modified_since >= lastModified
+            if notModified:
+                response = Response(status=304)
+            else:
+                response = app.make_response(func(*args, **kwargs))
+                # Errors and redirects don't have validators
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.last_modified = lastModified
+            return response
+
+        return respond
+
+    return decorator
+
+
+# Upgrade the database (if it's created by an older version)
+# before serving the first request
+@app.before_first_request
+def upgrade():
+    '''
+    Upgrades the database to the latest version
+    and renders the posts again if the renderer has changed
+    '''
+    upgradeDatabase()
+
+
+# Manifest of the built static files (see buildAssets())
+staticAssets = None
+
+
+# This function returns the manifest of the built static files
+def getStaticAssets() -> dict:
+    '''
+    Returns the manifest which maps the name of each static file
+    to its built file (it's loaded once in each process)
+    '''
+    global staticAssets
+    if staticAssets is None:
+        staticAssets = loadManifest(app.static_folder)
+    return staticAssets
+
+
+# url_for('static', filename=...) returns the address of the built file
+# if the static files are built (run 'flask build-assets')
+@app.url_defaults
+def staticAssetUrl(endpoint: str, values: dict):
+    '''
+    Replaces the name of a static file with its fingerprinted name
+    '''
+    if endpoint == 'static' and values.get('filename') in getStaticAssets():
+        values['filename'] = getStaticAssets()[values['filename']]
+
+
+# This function sends the static files
+def sendStaticFile(filename: str):
+    '''
+    Sends a static file, built files are sent gzipped (if the client
+    supports it) and they're cached forever because their names change
+    whenever their contents change
+    '''
+    if not filename.startswith(ASSETS_DIR + '/'):
+        return app.send_static_file(filename)
+    # Use the .gz file which is made by buildAssets()
+    if request.accept_encodings['gzip'] and os.path.isfile(
+            os.path.join(app.static_folder, filename + '.gz')):
+        response = send_from_directory(
+            app.static_folder, filename + '.gz',
+            mimetype=mimetypes.guess_type(filename)[0])
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = app.send_static_file(filename)
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+app.view_functions['static'] = sendStaticFile
+
+
+# Cache-Control header of the responses of each route (for the visitors)
+# Public pages can be stored by proxies but they must be revalidated
+# using their ETag (see conditional()) before they're used
+CACHE_CONTROL = {
+    'index': 'public, no-cache',
+    'page': 'public, no-cache',
+    'show': 'public, no-cache',
+    'comments': 'public, no-cache',
+    'csrftoken': 'no-store',
+    'cachestats': 'no-store',
+}
+
+
 # Add some headers to prevent some attacks
 # and log the events
 @app.after_request
 def after_request(response):
     '''
-    Add some headers to prevent some attacks and log the events
+    Add some headers to prevent some attacks, add the Cache-Control
+    header of the route and log the events
     '''
     # Add some headers
     response.headers['X-Content-Type-Options'] = 'nosniff'
     response.headers['X-Frame-Options'] = 'SAMEORIGIN'
     response.headers['X-XSS-Protection'] = '1; mode=block'
+    # Admins' pages must not be stored by proxies
+    policy = CACHE_CONTROL.get(request.endpoint)
+    if policy and 'Cache-Control' not in response.headers:
+        if g.get('admin') and policy != 'no-store':
+            policy = 'private, no-cache'
+        response.headers['Cache-Control'] = policy
     # Log the request and response
     logger.info('[' + request.remote_addr + '] ' + \
         '<' + request.method + '>' + \
@@ -886,34 +2155,92 @@ def sidebar():
     '''
     # Get configuration
     config = getConfig()
-    # Find all categories and save it to 'categories' array
-    categories = dbcategory.query.all()
-    # We'll show 4 most popular hashtags (favtags)
-    # and 4 most used hashtags (frqtags)
-    # Find 4 most popular hashtags and save it to 'favtags' array
-    favtags = dbtag.query.order_by(dbtag.popularity.desc()).limit(4).all()
-    # Find 4 most used hashtags and save it to 'frqtags' array
-    frqtags = dbtag.query.order_by(dbtag.frequency.desc()).limit(4).all()
-    # Find all links and save it to 'links' array
-    links = dblink.query.order_by(dblink.order).all()
-    # Render the page with the provided data!
-    # Create login form
-    form = LoginForm()
+    # Categories, links and most used hashtags are cached
+    # until they change (see bumpGenerations())
+    key = 'sidebar/' + getGenerations('categories', 'links', 'tags')
+    items = cache.get(key)
+    if items is None:
+        cacheStats['sidebar', 'misses'] += 1
+        items = {}
+        # Find all categories and save it to 'categories' array
+        items['categories'] = [CategoryView(*row) for row in
+            db.session.query(dbcategory.catid, dbcategory.name).all()]
+        # Find 4 most used hashtags and save it to 'frqtags' array
+        items['frqtags'] = [TagView(*row) for row in
+            db.session.query(dbtag.keyword) \
+                .order_by(dbtag.frequency.desc()).limit(4).all()]
+        # Find all links and save it to 'links' array
+        items['links'] = [LinkView(*row) for row in
+            db.session.query(dblink.linkid, dblink.name, dblink.address) \
+                .order_by(dblink.order).all()]
+        cache.set(key, items)
+    else:
+        cacheStats['sidebar', 'hits'] += 1
+    # 4 most popular hashtags are cached for POPULAR_TAGS_TIMEOUT seconds
+    # (popularity changes on every click so we won't invalidate them)
+    key = 'sidebar/favtags/' + getGenerations('tags')
+    favtags = cache.get(key)
+    if favtags is None:
+        # Find 4 most popular hashtags and save it to 'favtags' array
+        favtags = [TagView(*row) for row in
+            db.session.query(dbtag.keyword) \
+                .order_by(dbtag.popularity.desc()).limit(4).all()]
+        cache.set(key, favtags, timeout=app.config['POPULAR_TAGS_TIMEOUT'])
     # Create the an object and fill it with the generated data
-    items = {}
+    items = dict(items)
     items['config'] = config
-    items['categories'] = categories
     items['favtags'] = favtags
-    items['frqtags'] = frqtags
-    items['links'] = links
-    items['loginform'] = form
-    items['admin'] = session['logged_in']
+    # Create login form (its CSRF token is requested from /csrftoken)
+    items['loginform'] = LoginForm(meta=NO_CSRF)
+    items['admin'] = g.admin
     # Return the sidebar object
     return items
 
 
+# Forms which are shown to the visitors are rendered without a CSRF token
+# (generating a token saves it in the session and sets a cookie)
+# The token is requested from /csrftoken just before submitting the form
+NO_CSRF = {'csrf': False}
+
+
+# This function sends a CSRF token to the client
+@app.route("/csrftoken", methods=['GET'])
+def csrftoken():
+    '''
+    Sends a new CSRF token (for the forms which are shown without one)
+    '''
+    # Each client must get its own token (see CACHE_CONTROL)
+    return Response(generate_csrf(), mimetype='text/plain')
+
+
+# This function generates the filter which is used to find the posts
+# after a specific post in a specific sort order (keyset pagination)
+def keysetFilter(keys: list, values: list):
+    '''
+    Generates a filter which matches the rows that come after
+    the row with 'values' sort keys when sorted by 'keys'
+
+    Parameters
+    ----------
+    keys : list
+            a list of (column, descending) tuples
+    values : list
+            a list of values of each column in 'keys'
+            (sort keys of the last row of the previous page)
+    '''
+    column, desc = keys[0]
+    # Rows which come after the given row using the first sort key
+    after = column < values[0] if desc else column > values[0]
+    if len(keys) == 1:
+        return after
+    # Use the next sort keys if the first sort key is equal
+    return or_(after, and_(column == values[0],
+                           keysetFilter(keys[1:], values[1:])))
+
+
 # This function handles our main page
 @app.route("/")
+@authentication_required
 def index():
     '''
     Renders the main page or Calls install() if blog is not configured yet
@@ -925,71 +2252,184 @@ def index():
     # we'll call install() to generate the default config
     # and make database file then we'll call saveConfig()
     # to make the config file and redirect user to the config page
-    if not os.path.isfile(CONFIG_FILE):
+    if getConfigVersion() is None:
         saveConfig(install())
         return redirect(url_for('config'))
-    # Get the config values
-    conf = getConfig()
     # If someone looks for a specific hashtag
     # we'll increase its popularity by 1
-    # Get the hashtag from the request
-    tag = request.args.get('tag', default='', type=str)
-    # Find the hashtag in database
-    t = dbtag.query.filter(dbtag.keyword == tag).first()
-    # If it's not a bad request and hashtag exists in the database
-    if t is not None:
-        # Increase its popularity by 1
-        t.popularity = t.popularity + 1
-        # Save changes to the database
-        db.session.commit()
+    # (clicks are saved to the database in batches)
+    countTagClick(request.args.get('tag', default='', type=str))
     # Render the main page
+    return renderIndex()
+
+
+# This function renders the main page
+# (clients which already have it get a 304 response instead)
+@conditional('categories', 'config', 'links', 'tags', popularTags=True)
+def renderIndex():
+    '''
+    Renders the main page (see index())
+    '''
     return render_template("index.html",
                            sidebar=sidebar(),
-                           config=conf,
-                           admin=session['logged_in'])
+                           config=getConfig(),
+                           admin=g.admin)
+
+
+# Arguments of the /page requests (and the keys of the cached pages)
+PAGE_ARGS = ('page', 'cursor', 'search', 'category', 'sort', 'tag',
+             'archive', 'since')
 
 
 # This function sends the posts to the client
+# (from the response cache if they're already generated)
 @app.route("/page", methods=['GET'])
 @limiter.limit("60/second")
 @authentication_required
+@conditional(*PAGE_GENERATIONS)
 def page():
+    '''
+    Sends the requested page from the response cache or generates it
+    using renderPage() and saves it in the response cache
+    (cached pages are used until the posts, comments, categories,
+    config or translations change)
+    '''
+    # Key of the requested page in the response cache
+    key = [request.args.get(name) for name in PAGE_ARGS]
+    key.append(getTranslations().version)
+    key = 'page/%s/%s/%s' % (
+        getGenerations(*PAGE_GENERATIONS), g.admin,
+        hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest())
+    cached = cache.get(key)
+    if cached is not None:
+        cacheStats['page', 'hits'] += 1
+        data, headers, variants = cached
+        status = 'HIT'
+    else:
+        cacheStats['page', 'misses'] += 1
+        response = app.make_response(renderPage())
+        # Errors aren't cached
+        if response.status_code != 200:
+            response.headers['X-Cache'] = 'MISS'
+            return response
+        # Save the page, its pagination headers and its compressed versions
+        data = response.get_data()
+        headers = [(name, value) for name, value in response.headers
+                   if name.startswith('X-')]
+        variants = {}
+        status = 'MISS'
+    # The page is compressed once for each encoding and the compressed
+    # version is saved with the page (CompressionMiddleware won't
+    # compress it again)
+    encoding = negotiateEncoding(request.headers.get('Accept-Encoding', ''))
+    if len(data) < app.config['COMPRESS_MIN_SIZE']:
+        encoding = None
+    if encoding is not None and encoding not in variants:
+        variants = dict(variants)
+        variants[encoding] = compress(data, encoding,
+                                      app.config['COMPRESS_LEVEL'])
+    if status == 'MISS' or variants is not cached[2]:
+        cache.set(key, (data, headers, variants))
+    response = Response(response=variants.get(encoding, data), status=200,
+                        headers=headers, mimetype='text/html')
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.headers['X-Cache'] = status
+    return response
+
+
+# This function generates the requested page of posts
+def renderPage():
     '''
     Finds the posts which is requested by user and generates the requested page 
     '''
     # Get data from the request
     pageNum = request.args.get('page', default=2, type=int)
+    cursor = request.args.get('cursor', default='', type=str)
     search = request.args.get('search', default='', type=str)
     category = request.args.get('category', default=-1, type=int)
     sort = request.args.get('sort', default='descdate', type=str)
     tag = request.args.get('tag', default='', type=str)
+    archive = request.args.get('archive', default='', type=str)
+    since = request.args.get('since', default='', type=str)
     # We'll use this object to execute database queries
     # and find the posts which user requested!
-    query = dbpost.query
+    # (we'll only load the columns that we show and the sort keys,
+    # and the rendered excerpt of the content instead of all of it)
+    query = db.session.query(
+        dbpost.postid, dbpost.title, dbpost.category, dbpost.mediaaddr,
+        dbpost.gdatetime, dbpost.timestamp, dbpost.flags, dbpost.pinned,
+        dbpost.comments, dbpost.approved_comments,
+        # Short posts don't have an excerpt so we'll show the whole post
+        db.case([(dbpost.excerpt == '', dbpost.html)],
+                else_=dbpost.excerpt).label('summary'),
+        (dbpost.excerpt != '').label('truncated')).select_from(dbpost)
     # Handle the requested arguments
     if category > -1:  # Find all posts in a specific category
         query = query.filter(dbpost.category == category)
-    if search != '':  # Find all posts that contain search string
-        query = query.filter(
-            or_(dbpost.content.contains(search),
-                dbpost.title.contains(search)))
+    if search != '':  # Find all posts that match the search string
+        match = searchQuery(search)
+        # Use the full-text search index instead of scanning all the posts
+        # and get a snippet of the matching part of each post's content
+        # (matches are marked with control characters which
+        # prcText() replaces with <mark>)
+        query = query.join(postsearch, postsearch.c.rowid == dbpost.postid) \
+            .filter(postsearch.c.dbpostsearch.op('MATCH')(match)
+                    if match else db.false()) \
+            .add_columns(db.func.snippet(literal_column('dbpostsearch'), 1,
+                                         '\x02', '\x03', '...', 48) \
+                            .label('snippet'))
+    if archive != '':
+        # Find all posts published in a specific month
+        # of the blog's calendar (/?archive=1399-01)
+        try:
+            year, month = map(int, archive.split('-'))
+            start, end = monthRange(year, month, getConfig()['calendar'])
+        except (ValueError, OverflowError):
+            # Overflows for the years which are too big for a date
+            return render_template('400.html'), 400
+        query = query.filter(dbpost.timestamp >= start,
+                             dbpost.timestamp < end)
+    if since != '':
+        # Find all posts published since a specific date (/?since=2020-03-20)
+        try:
+            start = toTimestamp(since + ' 00:00:00')
+        except ValueError:
+            return render_template('400.html'), 400
+        query = query.filter(dbpost.timestamp >= start)
     if tag != '':
         # Find all posts that contain a specific hashtag
-        # (We'll put a # before the tag
-        # because it's not included in request string! /?tag=python)
-        query = query.filter(dbpost.content.contains('#' + tag))
-    # Change the order and show pinned posts first
-    query = query.order_by(
-        db.case((((dbpost.flags.op('&')(2)) == 2, 1), ), else_=0).desc())
-    # Sort the posts as requested by user
-    if sort == 'ascdate':  # Sort by Date (Ascending Order)
-        query = query.order_by(dbpost.postid)
-    if sort == 'descdate' or sort == '':  # Sort by Date (Descending Order)
-        query = query.order_by(dbpost.postid.desc())
-    if sort == 'asccomments':  # Sort by Number of Comments (Ascending Order)
-        query = query.order_by(dbpost.comments)
-    if sort == 'desccomments':  # Sort by Number of Comments (Descending Order)
-        query = query.order_by(dbpost.comments.desc())
+        # using the posts <-> tags table (/?tag=python)
+        query = query.join(dbposttag, dbposttag.postid == dbpost.postid) \
+            .join(dbtag, dbtag.tagid == dbposttag.tagid) \
+            .filter(dbtag.keyword == tag)
+    # Pinned posts will be shown first in all sort orders
+    pinned = dbpost.pinned
+    # Sort keys (column, descending order) of each sort order
+    # the last key of each sort order is unique so we can use
+    # the sort keys of the last post of a page as the next page cursor
+    sortKeys = {
+        # Sort by Date (Ascending Order)
+        'ascdate': [(pinned, True), (dbpost.postid, False)],
+        # Sort by Date (Descending Order)
+        'descdate': [(pinned, True), (dbpost.postid, True)],
+        # Sort by Number of Comments (Ascending Order)
+        'asccomments': [(pinned, True), (dbpost.comments, False),
+                        (dbpost.postid, False)],
+        # Sort by Number of Comments (Descending Order)
+        'desccomments': [(pinned, True), (dbpost.comments, True),
+                         (dbpost.postid, True)],
+    }
+    # Sort by search rank (search results are paginated by offset)
+    if sort == 'relevance' and search != '':
+        keys = None
+        query = query.order_by(pinned.desc(), postsearch.c.rank)
+    # Sort the posts as requested by user (Date is the default sort order)
+    else:
+        keys = sortKeys.get(sort, sortKeys['descdate'])
+        query = query.order_by(*[column.desc() if desc else column
+                                 for column, desc in keys])
     # Get configuration
     config = getConfig()
     # Get ppp value from config object
@@ -997,11 +2437,40 @@ def page():
     ppp = config['ppp']
     # Get date/time format
     dtformat = config['dtformat']
-    # Limit the results to the number of Posts Per Page
-    results = query.offset(pageNum * ppp).limit(ppp)
+    # Old clients send the page number instead of a cursor
+    # so we'll skip the previous pages using offset
+    if 'page' in request.args:
+        keys = None
+    # The cursor contains the page number and the sort keys of
+    # the last post of the previous page (empty for the first page)
+    if cursor != '':
+        try:
+            cursor = [int(value) for value in cursor.split('.')]
+        except ValueError:
+            return render_template('400.html'), 400
+        # SQLite integers are signed 64-bit integers
+        if not all(-2 ** 63 <= value < 2 ** 63 for value in cursor):
+            return render_template('400.html'), 400
+        pageNum = cursor[0]
+        if keys is not None:
+            # Return "Bad Request" if the cursor doesn't match the sort order
+            if len(cursor) != len(keys) + 1:
+                return render_template('400.html'), 400
+            # Find the posts after the last post of the previous page
+            query = query.filter(keysetFilter(keys, cursor[1:]))
+    elif 'page' not in request.args:  # First page
+        pageNum = 0
+    if keys is None:
+        if not -2 ** 63 <= pageNum * ppp < 2 ** 63:
+            return render_template('400.html'), 400
+        query = query.offset(pageNum * ppp)
+    # Load one more post to find out if there's a next page
+    results = query.limit(ppp + 1).all()
+    hasMore = len(results) > ppp
+    results = results[:ppp]
     # Send "END." if there's no more results to
     # send with status code 200 which means the request was successful
-    if results.count() == 0:
+    if not results:
         return Response(response="END.", status=200, mimetype='text/html')
     # This small block of code will handle the positioning of the posts
     # (should they appear on the right side or the left side of the timeline?!)
@@ -1011,60 +2480,88 @@ def page():
         c = 1
     # Array of our posts (results)
     posts = []
-    # We'll use this loop to run the 'prcText' function on each post's content
-    # and replace all hashtags in each post
-    # with linked hashtags and format its date/time
+    # We'll use this loop to add the blog's address to the links of
+    # each post's rendered content and format its date/time
     for result in results:
-        post = {}  # A single post (we'll assign its values below!)
-        # We'll replace hashtags with linked hashtags
-        # using the 'prcText' function
+        # If it's a search result then we'll show the matching
+        # part of the post content instead of its beginning
+        # (and replace its hashtags using the 'prcText' function)
+        if search != '':
+            # Markup Hashtags and the matches
+            content = prcText(result.snippet, request.script_root,
+                              highlight=True)
+            # Add continue reading link to the end of the snippet
+            content = content + Markup('<br><br>' + \
+                '<a href="'+ request.script_root + '/show?id=' + \
+                str(result.postid) + '" class="hashtag">' + \
+                tr('Continue Reading...') + '</a>')
         # If the content length is greater than 512 characters then
         # we'll just show the first 512 characters of the post content
-        # and also remove the last word in the first 512 characters
-        # because it may be an incomplete word
-        if (len(result.__dict__['content']) > 512):
-            # Get first 512 characters of the post content
-            content = result.__dict__['content'][0:512]
-            # remove the last word in the first 512 characters of
-            # the post content because it may be an incomplete word
-            content = content[0:content.rfind(' ')]
-            # Markup Hashtags
-            post['content'] = prcText(content, request.script_root)
+        # (rendered when the post was saved)
+        elif result.truncated:
+            content = withScriptRoot(result.summary, request.script_root)
             # Add continue reading link to the end of the post content
-            post['content'] = post['content'] + Markup('...<br><br>' + \
+            content = content + Markup('<br><br>' + \
                 '<a href="'+ request.script_root + '/show?id=' + \
-                str(result.__dict__['postid']) + '" class="hashtag">' + \
+                str(result.postid) + '" class="hashtag">' + \
                 tr('Continue Reading...') + '</a>')
         else:
-            # Markup hashtags
-            post['content'] = prcText(result.__dict__['content'],
-                                      request.script_root)
-        # And format date/time using the 'formatDateTime' function
-        post['datetime'] = formatDateTime(result.__dict__['gdatetime'],
-                                          dtformat)
-        post['gdatetime'] = result.__dict__['gdatetime']
-        # Rest is the same without any modification!
-        post['postid'] = result.__dict__['postid']
-        post['title'] = result.__dict__['title']
-        post['category'] = result.__dict__['category']
-        post['mediaaddr'] = result.__dict__['mediaaddr']
-        # Set Post Pinned Flag to True if it's set in flags
-        post['pinned'] = True if (result.__dict__['flags'] & 2) == 2 else False
-        # If user is not admin then we'll show them approved comments
-        if (session['logged_in'] == False):
-            post['comments'] = dbcomment.query.filter(
-                dbcomment.pid == result.__dict__['postid']).filter(
-                    dbcomment.status >= 2).count()
-        else:  # If user is admin then we'll show them all comments
-            post['comments'] = result.__dict__['comments']
+            content = withScriptRoot(result.summary, request.script_root)
         # Put this post in our results
-        posts.append(post)
+        posts.append(PostView(
+            postid=result.postid,
+            title=result.title,
+            content=content,
+            # Format date/time using the 'formatDateTime' function
+            datetime=formatDateTime(result.timestamp, dtformat),
+            gdatetime=result.gdatetime,
+            category=result.category,
+            mediaaddr=result.mediaaddr,
+            # Set Post Pinned Flag to True if it's set in flags
+            pinned=(result.flags & 2) == 2,
+            # If user is not admin then we'll show them approved comments
+            comments=result.comments if g.admin \
+                else result.approved_comments))
     # Render results
-    return render_template("page.html",
-                           posts=posts,
-                           c=c,
-                           mimetype="text/html",
-                           admin=session['logged_in'])
+    response = app.make_response(render_template("page.html",
+                                                 posts=posts,
+                                                 c=c,
+                                                 mimetype="text/html",
+                                                 admin=g.admin))
+    # The client will use this cursor to request the next page
+    nextCursor = [pageNum + 1]
+    if keys is not None:
+        # Sort keys of the last post in this page
+        last = results[-1]
+        nextCursor += [getattr(last, column.key) for column, desc in keys]
+    response.headers['X-Next-Cursor'] = '.'.join(map(str, nextCursor))
+    # Let the client know if there's a next page
+    response.headers['X-Has-More'] = '1' if hasMore else '0'
+    return response
+
+
+# This function shows the statistics of the response cache
+@app.route("/cachestats", methods=['GET'])
+@login_required
+def cachestats():
+    '''
+    Returns the hits, misses and hit ratio of each cached response
+    and the formatted dates in this worker process as JSON
+    '''
+    stats = {}
+    for (name, result), count in cacheStats.items():
+        stats.setdefault(name, {'hits': 0, 'misses': 0})[result] = count
+    # Formatted dates (since the last config change)
+    info = formatCalendarDateTime.cache_info()
+    stats['datetime'] = {'hits': info.hits, 'misses': info.misses,
+                         'size': info.currsize, 'maxsize': info.maxsize,
+                         # Each miss adds an item (and removes an item
+                         # when the cache is full)
+                         'evictions': info.misses - info.currsize}
+    for item in stats.values():
+        item['ratio'] = item['hits'] / max(1, item['hits'] + item['misses'])
+    return Response(response=json.dumps(stats), status=200,
+                    mimetype='application/json')
 
 
 # This function handles config page and configurations
@@ -1150,6 +2647,7 @@ def config():
 # This function handles viewing and saving comments
 @app.route("/comments", methods=['POST', 'GET'])
 @authentication_required
+@conditional('posts', 'comments', 'config')
 def comments():
     '''
     Renders the comments page for a specific post 
@@ -1171,13 +2669,15 @@ def comments():
     # Set autoapproval value to true if it's enabled in config
     # or user has admin privileges
     autoapproval = 2 if config['autoapproval'] == 'Yes' \
-        or session['logged_in'] == True else 0
+        or g.admin else 0
     disablecomments = config['disablecomments']
     if disablecomments != 'Yes':
         disablecomments = 'Yes' if (post.flags & 1) == 1 else 'No'
     # Form object which holds the request data
     # We'll set postid value to hidden field
-    form = CommentForm(request.form, postid=postid)
+    # (the form is shown without a CSRF token, see NO_CSRF)
+    form = CommentForm(request.form, postid=postid,
+                       meta=None if request.method == 'POST' else NO_CSRF)
     # Validate the request data
     # and check if there's a new comment
     if form.validate_on_submit() and disablecomments != 'Yes':
@@ -1187,49 +2687,35 @@ def comments():
         website = form.website.data
         content = form.content.data
         postid = form.postid.data
-        gdatetime = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        gdatetime = datetime.datetime.now().strftime(DATETIME_FORMAT)
         status = autoapproval
         # Create a new comment with the data provided above
         comment = dbcomment(postid, content, gdatetime, name, website,
                             mailaddr, status)
         # Increase the number of comments of
         # the post which this comment belongs to
-        post.comments = post.comments + 1
+        # (using SQL expressions so concurrent comments won't get lost)
+        post.comments = dbpost.comments + 1
+        # Approved comments are counted separately
+        if status >= 2:
+            post.approved_comments = dbpost.approved_comments + 1
         # Add this new comment to the database
         db.session.add(comment)
         # Save changes to database
         db.session.commit()
+        bumpGenerations('comments')
         # If Automatic approval is disabled and user is not admin
-        if (not autoapproval) and (session['logged_in'] == False):
+        if (not autoapproval) and (not g.admin):
             # Inform the user that their comment
             # will appear after it is approved
             flash(tr("Thank you! Your comment " + \
                 "will appear after it is approved."))
     # Load all comments that belong to a specific post from the database
-    results = dbcomment.query.filter(dbcomment.pid == postid).all()
-    # Array of our comments (results)
-    comments = []
-    # We'll use this loop to run the 'formatDateTime' function
-    # on each comment to format its date/time
-    for result in results:
-        comment = {}  # A single comment (we'll assign its values below!)
-        # And format date/time using the 'formatDateTime' function
-        comment['datetime'] = formatDateTime(result.__dict__['gdatetime'],
-                                             dtformat)
-        # Rest is the same without any modification!
-        comment['content'] = result.__dict__['content']
-        comment['cmtid'] = result.__dict__['cmtid']
-        comment['name'] = result.__dict__['name']
-        comment['website'] = result.__dict__['website']
-        comment['emailaddr'] = result.__dict__['emailaddr']
-        comment['status'] = result.__dict__['status']
-        # If user is admin then we'll remove comment's unseen status
-        if (session['logged_in'] == True):
-            result.status = result.status | 1
-        # Put this comment in our results
-        comments.append(comment)
-    # Save changes to the database
-    db.session.commit()
+    comments = loadComments(dbcomment.pid == postid, dtformat)
+    # If user is admin then we'll remove comments' unseen status
+    # (visitors' requests never write to the database)
+    if g.admin and comments:
+        markCommentsSeen(dbcomment.pid == postid, comments[-1].cmtid)
     # Sort Comments and show new comments first!
     comments.reverse()
     # Disable Comments if necessary
@@ -1249,7 +2735,7 @@ def comments():
                            postid=postid,
                            form=form,
                            disablecomments=disablecomments,
-                           admin=session['logged_in'])
+                           admin=g.admin)
 
 
 # This function handles removing comments
@@ -1267,19 +2753,29 @@ def deletecomment():
         id = int(request.json.get('id'))
         # Find the comment by its id
         comment = dbcomment.query.filter(dbcomment.cmtid == id)
+        # Find the post which this comment belongs to
+        pid = comment.with_entities(dbcomment.pid).scalar()
         # Check if the comment exists
-        if comment.first() is None:
+        if pid is None:
             return ('', 400)
-        # Find the post which this comment belongs to
-        post = dbpost.query.filter(
-            dbpost.postid == comment.first().pid).first()
-        # Reduce the number of comments of
-        # the post which this comment belongs to
-        post.comments = post.comments - 1
-        # Delete the comment
-        comment.delete()
+        # Delete the comment (the status is checked by the deletes so
+        # a comment which is approved by another request at the same time
+        # is counted correctly)
+        approved = comment.filter(dbcomment.status >= 2) \
+            .delete(synchronize_session=False)
+        if not approved and not comment.delete(synchronize_session=False):
+            # It's already deleted by another request
+            db.session.rollback()
+            return ('', 400)
+        # Reduce the number of comments (and approved comments if
+        # it was approved) of the post which this comment belongs to
+        dbpost.query.filter(dbpost.postid == pid).update(
+            {dbpost.comments: dbpost.comments - 1,
+             dbpost.approved_comments: dbpost.approved_comments - approved},
+            synchronize_session=False)
         # Save changes to the database
         db.session.commit()
+        bumpGenerations('comments')
         # Return "Success!"
         return ('', 200)
     # Return "Failure!"
@@ -1300,14 +2796,26 @@ def approvecomment():
         # Get the comment id from the request
         id = int(request.json.get('id'))
         # Find the comment by its id
-        comment = dbcomment.query.filter(dbcomment.cmtid == id).first()
+        comment = dbcomment.query.filter(dbcomment.cmtid == id)
+        # Find the post which this comment belongs to
+        pid = comment.with_entities(dbcomment.pid).scalar()
         # Check if the comment exists
-        if comment is None:
+        if pid is None:
             return ('', 400)
-        # Change comment approval status to approved!
-        comment.status = 3
+        # Change comment approval status to approved! and increase the
+        # number of approved comments of the post which this comment
+        # belongs to if this request is the one which approved it
+        # (the update only changes the comment if it's not approved yet)
+        if comment.filter(dbcomment.status < 2).update(
+                {dbcomment.status: 3}, synchronize_session=False) == 1:
+            dbpost.query.filter(dbpost.postid == pid).update(
+                {dbpost.approved_comments: dbpost.approved_comments + 1},
+                synchronize_session=False)
+        else:
+            comment.update({dbcomment.status: 3}, synchronize_session=False)
         # Save changes to the database
         db.session.commit()
+        bumpGenerations('comments')
         # Return "Success!"
         return ('', 200)
     # Return "Failure!"
@@ -1326,34 +2834,12 @@ def commentmoderation():
     # Get date/time format
     dtformat = config['dtformat']
     # Load all comments that require approval
-    results = dbcomment.query.filter(dbcomment.status != 3) \
-        .order_by(dbcomment.cmtid.asc()).all()
-    # Array of our comments (results)
-    comments = []
-    # We'll use this loop to run the 'formatDateTime' function
-    # on each comment to format its date/time
-    for result in results:
-        comment = {}  # A single comment (we'll assign its values below!)
-        # And format date/time using the 'formatDateTime' function
-        comment['datetime'] = formatDateTime(result.__dict__['gdatetime'],
-                                             dtformat)
-        # Rest is the same without any modification!
-        comment['content'] = result.__dict__['content']
-        comment['cmtid'] = result.__dict__['cmtid']
-        comment['pid'] = result.__dict__['pid']
-        comment['name'] = result.__dict__['name']
-        comment['website'] = result.__dict__['website']
-        comment['emailaddr'] = result.__dict__['emailaddr']
-        comment['status'] = result.__dict__['status']
-        # Mark new comments as seen
-        if (session['logged_in'] == True):
-            result.status = result.status | 1
-        # Put this comment in our results
-        comments.append(comment)
+    comments = loadComments(dbcomment.status < 3, dtformat)
+    # Mark new comments as seen
+    if comments:
+        markCommentsSeen(dbcomment.status < 3, comments[-1].cmtid)
     # Sort Comments and show new comments first!
     comments.reverse()
-    # Save changes to database
-    db.session.commit()
     # Render the comment moderation page
     return render_template(
         "commentmoderation.html",
@@ -1442,12 +2928,8 @@ def post():
         if postid:
             # Find the post by its id
             post = dbpost.query.filter(dbpost.postid == int(postid)).first()
-            # Find the hashtags in the post
-            hashTags = re.findall(r"#(\w+)", post.content)
-            # Execute deleteTag for each hashtag in our old post content
-            # (we'll add the hashtags that used in the new post content later!)
-            for hashTag in set(hashTags):
-                deleteTag(hashTag)
+            # We'll compare the hashtags of the old and new content later
+            oldContent = post.content
             # Save the data from request in the existing post
             post.category = category
             post.title = title
@@ -1457,8 +2939,10 @@ def post():
         # If postid is empty then it's a new post
         # and user is not editing an existing post
         else:
+            # New posts don't have any old hashtags
+            oldContent = ''
             # Get the Date/Time
-            gdatetime = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            gdatetime = datetime.datetime.now().strftime(DATETIME_FORMAT)
             # New posts don't have any comment when they're getting published!
             comments = 0
             # Create a new post with the provided data
@@ -1471,36 +2955,14 @@ def post():
                              flags=flags)
             # Save this new post to database
             db.session.add(newpost)
-        # Save changes to the database
+            post = newpost
+            # Get the new post's id
+            db.session.flush()
+        # Update the hashtags which are added to or removed from the post
+        updateTags(post.postid, oldContent, content)
+        # Save the post and its hashtags to the database
         db.session.commit()
-        # Find all hashtags in the post content
-        hashTags = re.findall(r"#(\w+)", content)
-        # Process each hashtag in the content
-        for hashTag in set(hashTags):
-            # Find the hashtag in the database
-            tag = dbtag.query.filter(dbtag.keyword == hashTag)
-            # If it's a new hashtag
-            if tag.count() == 0:
-                # It's the first time this hashtag appeared in a post
-                # so frequency will be 1
-                frequency = 1
-                # Nobody clicked on the hashtag yet so popularity is unknown,
-                # we'll assign 0 to the popularity for now
-                popularity = 0
-                # Create this new hashtag
-                tag = dbtag(keyword=hashTag,
-                            frequency=frequency,
-                            popularity=popularity)
-                # Save this hashtag to database
-                db.session.add(tag)
-            # If it's an existing hashtag
-            else:
-                # Find the hashtag in the database
-                tag = tag.first()
-                # Increase its frequency by 1
-                tag.frequency = tag.frequency + 1
-            # Save changes to the database
-            db.session.commit()
+        bumpGenerations('posts', 'tags')
         # Return to index and let the user see the new post
         return redirect(url_for('index'))
     # Show error messages if there was any error(s) during validation
@@ -1512,11 +2974,11 @@ def post():
     return render_template("post.html",
                            categories=categories,
                            form=form,
-                           admin=session['logged_in'])
+                           admin=g.admin)
 
 
 # This function Removes the post from the database and
-# execute the 'deleteTag' function for its hashtags and remove its comments
+# updates its hashtags and remove its comments
 def removepost(id: int):
     '''
     Removes a single post from the database
@@ -1531,19 +2993,53 @@ def removepost(id: int):
     post = dbpost.query.filter(dbpost.postid == id)
     # Delete all the comments that belong to this specific post
     dbcomment.query.filter(dbcomment.pid == id).delete()
-    # Get post content
-    content = post.first().content
-    # And find all the hashtags in this content
-    hashTags = re.findall(r"#(\w+)", content)
-    # Execute the 'deleteTag' function for
-    # all the hashtags found in the content
-    for hashTag in set(hashTags):
-        # remove the hashtag or reduce its frequency
-        deleteTag(hashTag)
+    # Remove the post's hashtags or reduce their frequency
+    updateTags(id, post.first().content, '')
+    # Unlink the post from the rest of its hashtags (if there's any)
+    dbposttag.query.filter(dbposttag.postid == id).delete()
     # Delete the post
     post.delete()
     # Save changes to the database
     db.session.commit()
+    bumpGenerations('posts', 'comments', 'tags')
+
+
+# This function removes all the posts which match a condition
+# using a fixed number of statements (no matter how many posts match)
+def removeposts(condition):
+    '''
+    Removes the posts which match 'condition' and their comments
+    and reduces the frequency of their hashtags or removes the hashtags
+    (uses the posts <-> tags table instead of the posts content)
+    Changes will be saved in the current transaction (it doesn't commit)
+
+    Parameters
+    ----------
+    condition : 
+            a filter on the posts table
+            (for example : dbpost.category == 1)
+    '''
+    # IDs of the posts that we're going to remove
+    postids = db.select([dbpost.postid]).where(condition)
+    links = dbposttag.postid.in_(postids)
+    # Delete all the comments that belong to these posts
+    dbcomment.query.filter(dbcomment.pid.in_(postids)).delete(
+        synchronize_session=False)
+    # Reduce the frequency of each hashtag by the number of
+    # removed posts which contain that hashtag
+    dbtag.query.filter(dbtag.tagid.in_(
+        db.select([dbposttag.tagid]).where(links))).update(
+            {dbtag.frequency: dbtag.frequency - db.select(
+                [db.func.count()]).where(
+                    and_(links, dbposttag.tagid == dbtag.tagid)).as_scalar()},
+            synchronize_session=False)
+    # Unlink the posts from their hashtags
+    dbposttag.query.filter(links).delete(synchronize_session=False)
+    # Delete the hashtags which are not used in any post
+    dbtag.query.filter(dbtag.frequency <= 0).delete(
+        synchronize_session=False)
+    # Delete the posts
+    dbpost.query.filter(condition).delete(synchronize_session=False)
 
 
 # This function handles requests for deleting posts
@@ -1574,78 +3070,58 @@ def deletepost():
 # This function handles showing single posts
 @app.route("/show", methods=['GET'])
 @authentication_required
+@conditional('posts', 'comments', 'categories', 'config', 'links', 'tags',
+             popularTags=True)
 def show():
     '''
     Renders the show page which is used to show a single post and its details!
     '''
     # Get 'id' from the requested url, if it's empty we'll assign it '-1'
     id = request.args.get('id', default=-1, type=int)
-    # Find the post which user requested
-    result = dbpost.query.filter(dbpost.postid == id).first()
+    # Find the post which user requested and its category name
+    # (only the columns that we show)
+    result = db.session.query(
+        dbpost.postid, dbpost.title, dbpost.html, dbpost.gdatetime,
+        dbpost.timestamp, dbpost.mediaaddr, dbpost.flags, dbpost.comments,
+        dbpost.approved_comments, dbcategory.name.label('category')) \
+        .select_from(dbpost) \
+        .outerjoin(dbcategory, dbcategory.catid == dbpost.category) \
+        .filter(dbpost.postid == id).first()
     # Check if the requested post exists
     if result is None:
         # Render 400 error page and
         # returns error code 400 'Bad Request' to the client
         return render_template('400.html'), 400
-    # Find its category
-    category = dbcategory.query.filter(
-        dbcategory.catid == result.category).first()
     # Get configuration
     config = getConfig()
     # Get date/time format
     dtformat = config['dtformat']
-    # Create an empty post! We'll use it to send data to the client
-    post = {}
-    # Replace hashtags with linked hashtags!
-    post['content'] = prcText(result.content, request.script_root)
-    # Format date/time
-    post['datetime'] = formatDateTime(result.gdatetime, dtformat)
-    # Copy rest of the data
-    post['postid'] = result.__dict__['postid']
-    post['gdatetime'] = result.__dict__['gdatetime']
-    post['title'] = result.__dict__['title']
-    post['category'] = category.name
-    post['mediaaddr'] = result.__dict__['mediaaddr']
-    # If user is not admin then we'll show them approved comments
-    if (session['logged_in'] == False):
-        post['comments'] = dbcomment.query.filter(
-            dbcomment.pid == result.__dict__['postid']).filter(
-                dbcomment.status >= 2).count()
-    else:  # If user is admin then we'll show them all comments
-        post['comments'] = result.__dict__['comments']
+    # We'll use it to send data to the client
+    post = PostView(
+        postid=result.postid,
+        title=result.title,
+        # Content with linked hashtags! (rendered when the post was saved)
+        content=withScriptRoot(result.html, request.script_root),
+        # Format date/time
+        datetime=formatDateTime(result.timestamp, dtformat),
+        gdatetime=result.gdatetime,
+        category=result.category,
+        mediaaddr=result.mediaaddr,
+        pinned=(result.flags & 2) == 2,
+        # If user is not admin then we'll show them approved comments
+        comments=result.comments if g.admin \
+            else result.approved_comments)
     # Set autoapproval value to true if it's enabled in config
     # or user has admin privileges
     autoapproval = 2 if config['autoapproval'] == 'Yes' \
-        or session['logged_in'] == True else 0
+        or g.admin else 0
     disablecomments = config['disablecomments']
-    # Form object which holds the request data
-    # We'll set postid value to hidden field
-    form = CommentForm(request.form, postid=id)
     # Load all comments that belong to a specific post from the database
-    results = dbcomment.query.filter(dbcomment.pid == id).all()
-    # Array of our comments (results)
-    comments = []
-    # We'll use this loop to run the 'formatDateTime' function
-    # on each comment to format its date/time
-    for item in results:
-        comment = {}  # A single comment (we'll assign its values below!)
-        # And format date/time using the 'formatDateTime' function
-        comment['datetime'] = formatDateTime(item.__dict__['gdatetime'],
-                                             dtformat)
-        # Rest is the same without any modification!
-        comment['content'] = item.__dict__['content']
-        comment['cmtid'] = item.__dict__['cmtid']
-        comment['name'] = item.__dict__['name']
-        comment['website'] = item.__dict__['website']
-        comment['emailaddr'] = item.__dict__['emailaddr']
-        comment['status'] = item.__dict__['status']
-        # If user is admin then we'll remove comment's unseen status
-        if (session['logged_in'] == True):
-            item.status = item.status | 1
-        # Put this comment in our results
-        comments.append(comment)
-    # Save changes to the database
-    db.session.commit()
+    comments = loadComments(dbcomment.pid == id, dtformat)
+    # If user is admin then we'll remove comments' unseen status
+    # (visitors' requests never write to the database)
+    if g.admin and comments:
+        markCommentsSeen(dbcomment.pid == id, comments[-1].cmtid)
     # Sort Comments and show new comments first!
     comments.reverse()
     # Disable Comments if necessary
@@ -1657,8 +3133,9 @@ def show():
                            comments=comments,
                            disablecomments=disablecomments,
                            sidebar=sidebar(),
-                           form=CommentForm(postid=id),
-                           admin=session['logged_in'])
+                           # Its CSRF token is requested from /csrftoken
+                           form=CommentForm(postid=id, meta=NO_CSRF),
+                           admin=g.admin)
 
 
 # This function handles creating new categories
@@ -1693,6 +3170,7 @@ def newcategory():
         db.session.add(category)
         # Save changes to the database
         db.session.commit()
+        bumpGenerations('categories')
         # Return "Success!"
         return ('', 200)
     # Return "Failure!"
@@ -1740,6 +3218,7 @@ def editcategory():
         category.name = name
         # Save changes to the database
         db.session.commit()
+        bumpGenerations('categories')
         # Return "Success!"
         return ('', 200)
     # Return "Failure!"
@@ -1762,28 +3241,19 @@ def removecategory():
         # Return "Failure!" if 'id' is wrong!
         if dbcategory.query.filter(dbcategory.catid == id).first() is None:
             return ('', 400)
+        # Delete all the posts that belong to the category
+        # and their comments and hashtags
+        removeposts(dbpost.category == id)
         # Find the category by its id in the database and delete it
         dbcategory.query.filter(dbcategory.catid == id).delete()
-        # After deleting the category we'll delete
-        # all the posts that belong to that category too
-        # There's no Do..While in python
-        # so we'll use an endless While(True) Loop
-        while True:
-            # Find the posts that belong the removed category
-            post = dbpost.query.filter(dbpost.category == id).first()
-            # If the post doesn't exists!
-            if post is None:
-                break  # Break out of this endless loop
-            # Call 'removepost' to delete the post
-            # and its comments and hashtags
-            removepost(post.postid)
-            # If there's no category in database
-            # we'll make one! (to prevent errors!)
+        # If there's no category in database
+        # we'll make one! (to prevent errors!)
         if dbcategory.query.count() == 0:
             category = dbcategory(tr('Other'), 0)
             db.session.add(category)
-        # Save changes to the database
+        # Save all the changes to the database at once
         db.session.commit()
+        bumpGenerations('posts', 'comments', 'categories', 'tags')
         # Return "Success!"
         return ('', 200)
     # Return "Failure!"
@@ -1832,6 +3302,7 @@ def addlink():
         db.session.add(link)
         # Save changes to the database
         db.session.commit()
+        bumpGenerations('links')
         # Return "Success!"
         return ('', 200)
     # Return "Failure!"
@@ -1899,6 +3370,7 @@ def editlink():
             link.first().address = address
             # Save changes to the database
             db.session.commit()
+            bumpGenerations('links')
             # Return "Success!"
             return ('', 200)
     # Return "Failure!"
@@ -1925,6 +3397,7 @@ def removelink():
         dblink.query.filter(dblink.linkid == id).delete()
         # Save changes to the database
         db.session.commit()
+        bumpGenerations('links')
         # Return "Success!"
         return ('', 200)
     # Return "Failure!"
@@ -1982,3 +3455,120 @@ def logout():
     session.pop('logged_in', None)
     # Return to the main page
     return redirect(url_for('index'))
+
+
+# This command rebuilds the full-text search index
+# Run 'flask rebuild-search' inside the blog directory
+@app.cli.command('rebuild-search')
+def rebuildsearch():
+    '''
+    Creates the full-text search index of the posts (if it doesn't exist)
+    and rebuilds it from the existing posts in the database
+    '''
+    rebuildSearchIndex()
+    click.echo('Search index rebuilt (%d posts).' % dbpost.query.count())
+
+
+# This command links the existing posts to their hashtags
+# Run 'flask index-tags' inside the blog directory
+@app.cli.command('index-tags')
+def indextags():
+    '''
+    Fills the posts <-> tags table using the content of the existing posts
+    '''
+    click.echo('%d hashtag links added.' % indexPostTags())
+
+
+# This command recounts the comments of all the posts
+# Run 'flask recount-comments' inside the blog directory
+@app.cli.command('recount-comments')
+def recountcomments():
+    '''
+    Recounts the number of comments and approved comments of all the posts
+    '''
+    recountComments()
+    click.echo('Comments of %d posts recounted.' % dbpost.query.count())
+
+
+# This command upgrades the database to the latest version
+# Run 'flask upgrade-db' inside the blog directory
+@app.cli.command('upgrade-db')
+def upgradedb():
+    '''
+    Upgrades the database tables and indexes to the latest version
+    '''
+    count = upgradeDatabase()
+    click.echo('%d migrations applied, database version is %d.' %
+               (count, getDatabaseVersion()))
+
+
+# This command shows the active sqlite settings
+# Run 'flask sqlite-status' inside the blog directory
+@app.cli.command('sqlite-status')
+def sqlitestatus():
+    '''
+    Shows the sqlite version, database version
+    and the settings of a new database connection
+    '''
+    click.echo('database: %s' % app.config['SQLALCHEMY_DATABASE_URI'])
+    click.echo('sqlite_version: %s' % sqlite3.sqlite_version)
+    click.echo('user_version: %d' % getDatabaseVersion())
+    for name in app.config['SQLITE_PRAGMAS']:
+        value = db.session.execute('PRAGMA %s' % name).scalar()
+        click.echo('%s: %s' % (name, value))
+
+
+# This command builds the static files
+# Run 'flask build-assets' inside the blog directory
+@app.cli.command('build-assets')
+def buildassets():
+    '''
+    Minifies the stylesheets and saves the static files with
+    fingerprinted names and their gzipped versions (run it after
+    changing the static files)
+    '''
+    global staticAssets
+    staticAssets = buildAssets(app.static_folder)
+    click.echo('%d static files built.' % len(staticAssets))
+
+
+# This command makes the WOFF2 fonts which only contain
+# the characters that we use (fontTools and brotli are required)
+# Run 'flask subset-fonts' inside the blog directory
+@app.cli.command('subset-fonts')
+def subsetfonts():
+    '''
+    Subsets the fonts to the characters of the templates, the translations
+    and the persian and latin letters and digits and saves them as WOFF2
+    '''
+    characters = fontCharacters(
+        os.path.join(app.root_path, app.template_folder), TRANSLATIONS_FILE)
+    try:
+        results = subsetFonts(os.path.join(app.static_folder, 'fonts'),
+                              characters)
+    except ImportError:
+        raise click.ClickException(
+            'fontTools is not installed (pip install fonttools brotli).')
+    for name, before, after in results:
+        click.echo('%s: %d bytes -> %d bytes (woff2), %.1f%% saved' %
+                   (name, before, after, 100.0 * (before - after) / before))
+    before = sum(result[1] for result in results)
+    after = sum(result[2] for result in results)
+    click.echo('Total: %d bytes -> %d bytes, %d bytes saved' %
+               (before, after, before - after))
+
+
+# This command renders the content of the posts again
+# Run 'flask render-posts' inside the blog directory
+@app.cli.command('render-posts')
+@click.option('--all', 'everything', is_flag=True,
+              help='Render all the posts (not only the outdated ones).')
+def renderposts(everything):
+    '''
+    Renders the posts which are rendered by an older renderer
+    (or all the posts) using the current renderer
+    '''
+    if everything:
+        dbpost.query.update({dbpost.renderer: 0}, synchronize_session=False)
+        db.session.commit()
+    click.echo('%d posts rendered.' % renderPosts())
@@ -0,0 +1,266 @@
+# # # # #
+# RangiRangi
+# A simple flask based Microblogging CMS written in Python
+# Coded by AlefMim (github.com/alefmim)
+# Contact me at mralefmim@gmail.com
+# # # # # # # # # #
+
+import os
+import re
+import gzip
+import json
+import hashlib
+import glob
+
+# Built assets are saved in this directory (inside the static directory)
+ASSETS_DIR = 'dist'
+# Maps the name of each static file to its built (fingerprinted) file
+MANIFEST_FILE = 'manifest.json'
+# Files which are already compressed (no .gz file is made for them)
+COMPRESSED_TYPES = ('.woff', '.woff2', '.png', '.jpg', '.gif')
+# Characters which are always kept in the subsetted fonts
+# (posts and comments are also shown using these fonts so all
+# the persian letters, latin letters and digits are kept)
+FONT_RANGES = (
+    (0x0020, 0x007E),  # Basic latin (and latin digits)
+    (0x00A0, 0x00BB),  # No-break space, guillemets, ...
+    (0x0600, 0x06FF),  # Arabic and persian (and persian digits)
+    (0x200C, 0x200F),  # Zero-width non-joiner, joiner and direction marks
+    (0xFB50, 0xFDFF),  # Arabic presentation forms A
+    (0xFE70, 0xFEFF),  # Arabic presentation forms B
+)
+# url(...) in the stylesheets
+CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+
+
+# This function minifies a stylesheet
+def minifyCss(css: str) -> str:
+    '''
+    Removes the comments and the extra white space of a stylesheet
+
+    Parameters
+    ----------
+    css : str
+            Content of the stylesheet
+
+    Returns
+    -------
+    str
+            Minified stylesheet
+    '''
+    # Remove comments
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    # Replace white space with a single space
+    css = re.sub(r'\s+', ' ', css)
+    # Remove the spaces around the punctuations
+    # (spaces before ':' are kept, they're used in selectors)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    css = re.sub(r':\s+', ':', css)
+    # The last semicolon of each block isn't needed
+    css = css.replace(';}', '}')
+    return css.strip()
+
+
+# This function adds the hash of a file to its name
+def fingerprint(name: str, data: bytes) -> str:
+    '''
+    Returns the name of a file with the hash of its content
+    (like styles.0123abcd.css) so it can be cached forever
+
+    Parameters
+    ----------
+    name : str
+            Name of the file
+    data : bytes
+            Content of the file
+
+    Returns
+    -------
+    str
+            Fingerprinted name of the file
+    '''
+    root, extension = os.path.splitext(name)
+    return '%s.%s%s' % (root, hashlib.sha1(data).hexdigest()[:10], extension)
+
+
+# This function saves a built asset and its compressed version
+def saveAsset(staticFolder: str, name: str, data: bytes) -> str:
+    '''
+    Saves 'data' to the fingerprinted file of 'name' in the assets
+    directory and saves its gzipped version to a .gz file next to it
+
+    Parameters
+    ----------
+    staticFolder : str
+            Path of the static directory
+    name : str
+            Name of the static file (relative to the static directory)
+    data : bytes
+            Built content of the file
+
+    Returns
+    -------
+    str
+            Path of the built file (relative to the static directory)
+    '''
+    builtName = '/'.join((ASSETS_DIR, fingerprint(name, data)))
+    path = os.path.join(staticFolder, *builtName.split('/'))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as assetFile:
+        assetFile.write(data)
+    if not name.endswith(COMPRESSED_TYPES):
+        # mtime=0 so the same content makes the same .gz file
+        with open(path + '.gz', 'wb') as assetFile:
+            assetFile.write(gzip.compress(data, compresslevel=9, mtime=0))
+    return builtName
+
+
+# This function builds the static files
+# Run 'flask build-assets' to build them
+def buildAssets(staticFolder: str) -> dict:
+    '''
+    Builds all the static files into the assets directory:
+    stylesheets are minified, the files they use are replaced with their
+    built files, all the names are fingerprinted and .gz files are made
+    Each page loads its own stylesheet and styles.css (which is shared
+    between the pages) so the stylesheets aren't merged
+
+    Parameters
+    ----------
+    staticFolder : str
+            Path of the static directory
+
+    Returns
+    -------
+    dict
+            Manifest which maps the name of each static file to its
+            built file (it's also saved to the manifest file)
+    '''
+    # Old built files aren't removed (cached pages may still use them)
+    names = []
+    for directory, subdirectories, files in os.walk(staticFolder):
+        relative = os.path.relpath(directory, staticFolder)
+        if relative.split(os.sep)[0] == ASSETS_DIR:
+            continue
+        for name in files:
+            names.append(os.path.normpath(os.path.join(relative, name))
+                         .replace(os.sep, '/'))
+    manifest = {}
+    # Stylesheets use the other files so they're built at the end
+    for name in sorted(names, key=lambda name: (name.endswith('.css'), name)):
+        with open(os.path.join(staticFolder, *name.split('/')), 'rb') as f:
+            data = f.read()
+        if name.endswith('.css'):
+            base = os.path.dirname(name)
+
+            def builtUrl(match):
+                url, query = re.match(r'([^?#]*)(.*)',
+                                      match.group(2)).groups()
+                path = os.path.normpath(os.path.join(base, url)) \
+                    .replace(os.sep, '/')
+                # Address of the built file relative to the built stylesheet
+                if path in manifest:
+                    url = os.path.relpath(
+                        manifest[path], os.path.dirname(
+                            '/'.join((ASSETS_DIR, name)))).replace(os.sep, '/')
+                return "url('%s%s')" % (url, query)
+            data = minifyCss(CSS_URL.sub(builtUrl, data.decode('utf-8')))
+            data = data.encode('utf-8')
+        manifest[name] = saveAsset(staticFolder, name, data)
+    with open(os.path.join(staticFolder, ASSETS_DIR, MANIFEST_FILE),
+              'w') as manifestFile:
+        json.dump(manifest, manifestFile, indent=4, sort_keys=True)
+    return manifest
+
+
+# This function loads the manifest of the built static files
+def loadManifest(staticFolder: str) -> dict:
+    '''
+    Returns the manifest of the built static files
+    (an empty dictionary if they're not built yet)
+    '''
+    try:
+        with open(os.path.join(staticFolder, ASSETS_DIR, MANIFEST_FILE),
+                  'r') as manifestFile:
+            return json.load(manifestFile)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+# This function finds the characters which are shown using our fonts
+def fontCharacters(*paths: str) -> set:
+    '''
+    Returns the characters of the given files (the templates and the
+    translations) and the characters of FONT_RANGES
+
+    Parameters
+    ----------
+    paths : str
+            Paths of the files which contain the texts or the directories
+            which contain the templates (.html files)
+
+    Returns
+    -------
+    set
+            Unicode code points of the characters
+    '''
+    characters = set()
+    for first, last in FONT_RANGES:
+        characters.update(range(first, last + 1))
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            # Only the templates (not the other files of the directory)
+            files.extend(sorted(filter(os.path.isfile, glob.glob(
+                os.path.join(path, '*.html')))))
+        else:
+            files.append(path)
+    for name in files:
+        with open(name, 'r', encoding='utf-8-sig') as textFile:
+            characters.update(map(ord, textFile.read()))
+    # Control characters aren't shown
+    return {character for character in characters if character >= 0x20}
+
+
+# This function subsets our fonts and saves them in WOFF2 format
+# Run 'flask subset-fonts' to make them (fontTools and brotli are required)
+def subsetFonts(fontsFolder: str, characters: set) -> list:
+    '''
+    Removes the glyphs which aren't used from each .ttf font and saves
+    it as a .woff2 file next to it (shaping and kerning are kept)
+
+    Parameters
+    ----------
+    fontsFolder : str
+            Path of the fonts directory
+    characters : set
+            Unicode code points of the characters which must be kept
+
+    Returns
+    -------
+    list
+            a list of (name, old size, woff2 size) tuples
+            (old size is the size of the .woff font or the .ttf font
+            if there's no .woff font)
+    '''
+    # It's only needed when the fonts are changed
+    from fontTools import subset
+    options = subset.Options()
+    options.flavor = 'woff2'
+    options.layout_features = ['*']
+    options.name_IDs = ['*']
+    options.name_languages = ['*']
+    options.notdef_outline = True
+    results = []
+    for path in sorted(glob.glob(os.path.join(fontsFolder, '*.ttf'))):
+        root = os.path.splitext(path)[0]
+        font = subset.load_font(path, options)
+        subsetter = subset.Subsetter(options)
+        subsetter.populate(unicodes=characters)
+        subsetter.subset(font)
+        subset.save_font(font, root + '.woff2', options)
+        font.close()
+        old = root + '.woff' if os.path.isfile(root + '.woff') else path
+        results.append((os.path.basename(root), os.path.getsize(old),
+                        os.path.getsize(root + '.woff2')))
+    return results
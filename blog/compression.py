@@ -0,0 +1,176 @@
+# # # # #
+# RangiRangi
+# A simple flask based Microblogging CMS written in Python
+# Coded by AlefMim (github.com/alefmim)
+# Contact me at mralefmim@gmail.com
+# # # # # # # # # #
+
+import re
+import gzip
+
+# zstd is used if the zstandard package is installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Supported encodings in the order of preference
+ENCODINGS = ('zstd', 'gzip') if zstandard is not None else ('gzip',)
+# Types of the responses which are compressed
+# (images and fonts are already compressed)
+COMPRESSIBLE_TYPES = re.compile(
+    r'^(text/|application/(json|javascript|xml)|image/svg\+xml)')
+# Suffix of the ETag of a compressed response (inside the quotes)
+ETAG_SUFFIX = re.compile(r'-(%s)"' % '|'.join(ENCODINGS))
+
+
+# This function chooses the encoding of a response
+def negotiateEncoding(acceptEncoding: str) -> str:
+    '''
+    Returns the best encoding which is accepted by the client
+
+    Parameters
+    ----------
+    acceptEncoding : str
+            Value of the Accept-Encoding header of the request
+
+    Returns
+    -------
+    str
+            'zstd', 'gzip' or None if the client doesn't accept any of them
+    '''
+    accepted = {}
+    for item in acceptEncoding.lower().split(','):
+        name, _, parameters = item.strip().partition(';')
+        quality = 1.0
+        match = re.search(r'q=([0-9.]+)', parameters)
+        if match:
+            try:
+                quality = float(match.group(1))
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip()] = quality
+    # 'x-gzip' is the same as 'gzip'
+    if 'gzip' not in accepted and 'x-gzip' in accepted:
+        accepted['gzip'] = accepted['x-gzip']
+    for encoding in ENCODINGS:
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+# This function compresses the content of a response
+def compress(data: bytes, encoding: str, level: int = 6) -> bytes:
+    '''
+    Compresses 'data' using 'encoding' ('zstd' or 'gzip')
+    '''
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    # mtime=0 so the same content makes the same bytes
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+# This function changes the ETag of a response for a compressed version
+def compressedETag(etag: str, encoding: str) -> str:
+    '''
+    Adds the encoding to an ETag ("abc" -> "abc-gzip") because
+    the compressed response is a different representation
+    '''
+    if etag.endswith('"') and not etag.endswith('-%s"' % encoding):
+        etag = etag[:-1] + '-%s"' % encoding
+    return etag
+
+
+# A WSGI middleware which compresses the responses
+# app.wsgi_app = CompressionMiddleware(app.wsgi_app) enables it
+class CompressionMiddleware(object):
+    '''
+    Compresses the responses using gzip (or zstd) if the client
+    accepts it and the response is big enough to be worth compressing
+    (responses which are already compressed by the application,
+    for example the cached pages, are sent as they are)
+
+    Parameters
+    ----------
+    app : callable
+            The WSGI application
+    minimumSize : int
+            Smaller responses aren't compressed
+    level : int
+            Compression level
+    '''
+
+    def __init__(self, app, minimumSize: int = 512, level: int = 6):
+        self.app = app
+        self.minimumSize = minimumSize
+        self.level = level
+
+    def __call__(self, environ, start_response):
+        encoding = negotiateEncoding(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return self.app(environ, start_response)
+        # The application only knows the ETags of the uncompressed responses
+        ifNoneMatch = environ.get('HTTP_IF_NONE_MATCH')
+        if ifNoneMatch:
+            environ['HTTP_IF_NONE_MATCH'] = ETAG_SUFFIX.sub('"', ifNoneMatch)
+        # Only the responses which may be compressed are kept in memory,
+        # everything else is sent as the application sends it
+        buffered = []
+        body = []
+        returned = []
+
+        def startResponse(status, headers, exc_info=None):
+            names = {name.lower(): value for name, value in headers}
+            compressible = status.startswith('200') and \
+                environ.get('REQUEST_METHOD') != 'HEAD' and \
+                COMPRESSIBLE_TYPES.match(names.get('content-type', '')) and \
+                'no-transform' not in names.get('cache-control', '')
+            # Not Modified responses of the compressed responses
+            notModified = status.startswith('304') and ifNoneMatch and \
+                '-%s"' % encoding in ifNoneMatch
+            # The response depends on the Accept-Encoding header
+            if (compressible or notModified) and 'accept-encoding' not in \
+                    names.get('vary', '').lower():
+                headers = [(name, value) for name, value in headers
+                           if name.lower() != 'vary']
+                headers.append(('Vary', ', '.join(filter(None, (
+                    names.get('vary'), 'Accept-Encoding')))))
+            # Compressed responses (and their Not Modified responses)
+            # have their own ETags
+            if notModified or names.get('content-encoding') == encoding:
+                headers = [(name, compressedETag(value, encoding)
+                            if name.lower() == 'etag' else value)
+                           for name, value in headers]
+            # Responses which are already compressed (or known to be too
+            # small) are sent as they are
+            # (the application must call start_response before returning
+            # the body for it to be compressed)
+            if not compressible or 'content-encoding' in names or \
+                    int(names.get('content-length') or self.minimumSize) < \
+                    self.minimumSize or returned:
+                buffered[:] = []
+                return start_response(status, headers, exc_info)
+            buffered[:] = [status, headers, exc_info]
+            return body.append
+
+        appIter = self.app(environ, startResponse)
+        returned.append(True)
+        if not buffered:
+            return appIter
+        try:
+            body.extend(appIter)
+        finally:
+            if hasattr(appIter, 'close'):
+                appIter.close()
+        status, headers, exc_info = buffered
+        data = b''.join(body)
+        if len(data) >= self.minimumSize:
+            data = compress(data, encoding, self.level)
+            headers = [(name, compressedETag(value, encoding)
+                        if name.lower() == 'etag' else value)
+                       for name, value in headers
+                       if name.lower() != 'content-length']
+            headers.append(('Content-Encoding', encoding))
+            headers.append(('Content-Length', str(len(data))))
+        start_response(status, headers, exc_info)
+        return [data]
@@ -0,0 +1,278 @@
+# # # # #
+# RangiRangi
+# A simple flask based Microblogging CMS written in Python
+# Coded by AlefMim (github.com/alefmim)
+# Contact me at mralefmim@gmail.com
+# # # # # # # # # #
+
+import os
+import time
+import pickle
+import sqlite3
+import logging
+import threading
+import contextlib
+
+from flask_caching.backends.base import BaseCache
+
+logger = logging.getLogger(__name__)
+
+# Errors which pickle.loads() may raise for a corrupt value
+UNPICKLING_ERRORS = (pickle.PickleError, EOFError, AttributeError,
+                     ImportError, IndexError, TypeError, ValueError)
+
+
+# A Flask-Caching backend which keeps the cached items in a sqlite file
+# so all the worker processes share the same cache
+# Set CACHE_TYPE to 'blog.sqlitecache.sqlite' to use it
+class SQLiteCache(BaseCache):
+    '''
+    A cache which is shared between processes using a sqlite database file
+    (expired items are ignored and the least recently used items
+    are removed when the cache has more than 'threshold' items)
+    Like the other Flask-Caching backends it doesn't raise if the cache
+    file can't be used (for example when it's locked for too long),
+    reads are misses and writes return False
+
+    Parameters
+    ----------
+    path : str
+            Path of the cache database file
+    threshold : int
+            Maximum number of the items
+    default_timeout : int
+            Default timeout of the items in seconds (0 means forever)
+    touchInterval : float
+            The last access time of an item is saved at most once
+            in 'touchInterval' seconds (to avoid writing on every read)
+    pruneInterval : int
+            The cache is pruned after every 'pruneInterval' writes
+    '''
+
+    def __init__(self, path: str, threshold: int = 500,
+                 default_timeout: int = 300, touchInterval: float = 1.0,
+                 pruneInterval: int = 16):
+        super(SQLiteCache, self).__init__(default_timeout)
+        self.path = path
+        self.threshold = threshold
+        self.touchInterval = touchInterval
+        self.pruneInterval = pruneInterval
+        # Number of writes since the last prune (in this process)
+        self.writes = 0
+        # Each thread of each process has its own connection
+        self.local = threading.local()
+        with self.connect() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS cache (' + \
+                'key TEXT PRIMARY KEY, value BLOB NOT NULL, ' + \
+                'expires REAL NOT NULL, accessed REAL NOT NULL)')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS ix_cache_accessed ' + \
+                'ON cache (accessed)')
+
+    def connect(self) -> sqlite3.Connection:
+        '''
+        Returns the connection of the current thread
+        (opens a new one if it's a new thread or a forked process)
+        '''
+        if getattr(self.local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5,
+                                         isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = NORMAL')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''
+        Returns the connection of the current thread inside a transaction
+        which has locked the cache for writing (it's committed at the end
+        or rolled back if there's an error)
+        '''
+        connection = self.connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+            connection.execute('COMMIT')
+        except BaseException:
+            # sqlite may have already rolled it back
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            raise
+
+    def _normalize_timeout(self, timeout):
+        timeout = BaseCache._normalize_timeout(self, timeout)
+        if timeout > 0:
+            timeout = time.time() + timeout
+        return timeout
+
+    def get(self, key):
+        return self.get_many(key)[0]
+
+    def get_many(self, *keys):
+        if not keys:
+            return []
+        now = time.time()
+        try:
+            connection = self.connect()
+            rows = connection.execute(
+                'SELECT key, value, accessed FROM cache ' + \
+                'WHERE key IN (%s) AND (expires = 0 OR expires > ?)' % \
+                    ','.join('?' * len(keys)), keys + (now,)).fetchall()
+        except sqlite3.Error:
+            logger.warning('Exception raised while reading the cache',
+                           exc_info=True)
+            return [None] * len(keys)
+        values = {}
+        touched = []
+        for key, value, accessed in rows:
+            try:
+                values[key] = pickle.loads(value)
+            except UNPICKLING_ERRORS:
+                continue
+            if now - accessed >= self.touchInterval:
+                touched.append((now, key))
+        # Save the access time (for removing the least recently used items)
+        # (it's not important if it can't be saved this time)
+        if touched:
+            try:
+                connection.executemany(
+                    'UPDATE cache SET accessed = ? WHERE key = ?', touched)
+            except sqlite3.Error:
+                pass
+        return [values.get(key) for key in keys]
+
+    def set(self, key, value, timeout=None):
+        return self.set_many({key: value}, timeout)
+
+    def set_many(self, mapping, timeout=None):
+        expires = self._normalize_timeout(timeout)
+        now = time.time()
+        items = [(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                  expires, now) for key, value in dict(mapping).items()]
+        try:
+            with self.transaction() as connection:
+                connection.executemany(
+                    'INSERT OR REPLACE INTO cache (key, value, expires, ' + \
+                    'accessed) VALUES (?, ?, ?, ?)', items)
+                self.prune(connection, len(items))
+        except sqlite3.Error:
+            logger.warning('Exception raised while writing to the cache',
+                           exc_info=True)
+            return False
+        return True
+
+    def add(self, key, value, timeout=None):
+        expires = self._normalize_timeout(timeout)
+        now = time.time()
+        try:
+            with self.transaction() as connection:
+                # Expired items don't count
+                connection.execute(
+                    'DELETE FROM cache WHERE key = ? AND expires != 0 ' + \
+                    'AND expires <= ?', (key, now))
+                added = connection.execute(
+                    'INSERT OR IGNORE INTO cache (key, value, expires, ' + \
+                    'accessed) VALUES (?, ?, ?, ?)',
+                    (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                     expires, now)).rowcount == 1
+                self.prune(connection, 1)
+        except sqlite3.Error:
+            logger.warning('Exception raised while writing to the cache',
+                           exc_info=True)
+            return False
+        return added
+
+    def inc(self, key, delta=1):
+        # Read and write in a single transaction
+        # so concurrent increments won't get lost
+        # (the value isn't reset if it can't be read)
+        try:
+            with self.transaction() as connection:
+                row = connection.execute(
+                    'SELECT value FROM cache WHERE key = ? AND ' + \
+                    '(expires = 0 OR expires > ?)',
+                    (key, time.time())).fetchone()
+                value = (pickle.loads(row[0]) if row else 0) + delta
+                connection.execute(
+                    'INSERT OR REPLACE INTO cache (key, value, expires, ' + \
+                    'accessed) VALUES (?, ?, ?, ?)',
+                    (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                     self._normalize_timeout(None), time.time()))
+        except (sqlite3.Error,) + UNPICKLING_ERRORS:
+            logger.warning('Exception raised while writing to the cache',
+                           exc_info=True)
+            return None
+        return value
+
+    def dec(self, key, delta=1):
+        return self.inc(key, -delta)
+
+    def delete(self, key):
+        try:
+            return self.connect().execute(
+                'DELETE FROM cache WHERE key = ?', (key,)).rowcount == 1
+        except sqlite3.Error:
+            logger.warning('Exception raised while writing to the cache',
+                           exc_info=True)
+            return False
+
+    def delete_many(self, *keys):
+        try:
+            self.connect().executemany('DELETE FROM cache WHERE key = ?',
+                                       [(key,) for key in keys])
+        except sqlite3.Error:
+            logger.warning('Exception raised while writing to the cache',
+                           exc_info=True)
+            return False
+        return True
+
+    def has(self, key):
+        try:
+            return self.connect().execute(
+                'SELECT 1 FROM cache WHERE key = ? AND ' + \
+                '(expires = 0 OR expires > ?)', (key, time.time())) \
+                .fetchone() is not None
+        except sqlite3.Error:
+            logger.warning('Exception raised while reading the cache',
+                           exc_info=True)
+            return False
+
+    def clear(self):
+        try:
+            self.connect().execute('DELETE FROM cache')
+        except sqlite3.Error:
+            logger.warning('Exception raised while writing to the cache',
+                           exc_info=True)
+            return False
+        return True
+
+    def prune(self, connection: sqlite3.Connection, writes: int):
+        '''
+        Removes the expired items and the least recently used items
+        if there's more than 'threshold' items in the cache
+        (runs after every 'pruneInterval' writes)
+        '''
+        self.writes = self.writes + writes
+        if self.writes < self.pruneInterval:
+            return
+        self.writes = 0
+        connection.execute(
+            'DELETE FROM cache WHERE expires != 0 AND expires <= ?',
+            (time.time(),))
+        connection.execute(
+            'DELETE FROM cache WHERE key IN (SELECT key FROM cache ' + \
+            'ORDER BY accessed LIMIT max(0, ' + \
+            '(SELECT count(*) FROM cache) - ?))', (self.threshold,))
+
+
+# Flask-Caching calls this function to create the cache
+def sqlite(app, config, args, kwargs):
+    '''
+    Creates a SQLiteCache using CACHE_SQLITE_PATH and CACHE_THRESHOLD
+    '''
+    kwargs.update(dict(threshold=config['CACHE_THRESHOLD']))
+    return SQLiteCache(config['CACHE_SQLITE_PATH'], *args, **kwargs)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# Compares the single-pass prcText() with the old implementation
+# which replaced each hashtag using str.replace()
+# Run 'python -m test.benchmark_prctext' inside the project directory
+
+import re
+import random
+import timeit
+
+from flask import Markup
+from blog.app import prcText
+
+
+def oldPrcText(rawText: str, url: str) -> str:
+    '''
+    The old implementation of prcText() (one replace for each hashtag)
+    '''
+    hashTags = re.findall(r"#(\w+)", rawText)
+    for hashTag in set(hashTags):
+        rawText = rawText.replace(
+            '#' + hashTag, "<a href='" + url + "/?tag=" + hashTag +
+            "' class='hashtag'>#" + hashTag + "</a>")
+    rawText = rawText.replace('\n', '<br>')
+    return Markup(rawText)
+
+
+def makePost(size: int, tags: int) -> str:
+    '''
+    Generates a post containing about 'size' characters and
+    'tags' different hashtags, links and new lines
+    '''
+    random.seed(size)
+    words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'https://site.com/x',
+             '\n'] + ['#tag%d' % i for i in range(tags)]
+    text = []
+    length = 0
+    while length < size:
+        word = random.choice(words)
+        text.append(word)
+        length = length + len(word) + 1
+    return ' '.join(text)
+
+
+if __name__ == '__main__':
+    print('%10s %6s %12s %12s %8s' % ('size', 'tags', 'old (ms)',
+                                      'new (ms)', 'speedup'))
+    for size in (10 * 1024, 100 * 1024, 1024 * 1024):
+        for tags in (100, 500):
+            post = makePost(size, tags)
+            number = max(1, 2 * 1024 * 1024 // size)
+            old = min(timeit.repeat(lambda: oldPrcText(post, '/blog'),
+                                    number=number, repeat=3)) / number
+            new = min(timeit.repeat(lambda: prcText(post, '/blog'),
+                                    number=number, repeat=3)) / number
+            print('%10d %6d %12.2f %12.2f %7.1fx' % (size, tags, old * 1000,
+                                                     new * 1000, old / new))
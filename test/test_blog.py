@@ -2,12 +2,41 @@
 import os
 import unittest
 import datetime
+import tempfile
+import shutil
+import gzip
+import importlib.util
+import multiprocessing
+
+from unittest import mock
 
 from urllib.request import Request
 from flask_testing import TestCase
 from flask import session
 from blog import *
 from blog.app import *
+import blog.app
+from blog.sqlitecache import SQLiteCache
+from blog.compression import (
+    ENCODINGS,
+    negotiateEncoding,
+    compress,
+    compressedETag,
+)
+from blog.assets import (
+    minifyCss,
+    buildAssets,
+    loadManifest,
+    fontCharacters,
+    subsetFonts,
+)
+
+
+def incrementCache(count):
+    '''Increments a cached counter in another process.'''
+    for i in range(count):
+        cache.cache.inc('counter')
+    bumpGenerations('posts')
 
 
 class BlogTests(TestCase):
@@ -27,6 +56,7 @@ class BlogTests(TestCase):
         self.db = SQLAlchemy(app)
         db.drop_all()
         db.create_all()
+        cache.clear()
 
     def make_config_file(self):
         session['logged_in'] = True
@@ -88,7 +118,7 @@ class BlogTests(TestCase):
             response = self.client.get('/')
             self.assertEqual(request.path, url_for('index'))
             self.assertEqual(response.status_code, 200)
-            self.assertEqual(session['logged_in'], False)
+            self.assertNotIn('logged_in', session)
             self.assertIn(b'Blog Title', response.data)
             self.assertIn(b'Blog Description', response.data)
             self.assertIn(b'test@test.com', response.data)
@@ -103,7 +133,7 @@ class BlogTests(TestCase):
         with self.client:
             response = self.client.get('/logout', follow_redirects=True)
             self.assertEqual(response.status_code, 200)
-            self.assertEqual(session['logged_in'], False)
+            self.assertNotIn('logged_in', session)
             self.login()
             response = self.logout()
             self.assertEqual(response.status_code, 302)
@@ -117,7 +147,7 @@ class BlogTests(TestCase):
                                         data=dict(pwd='nimda'),
                                         follow_redirects=True)
             self.assertEqual(response.status_code, 200)
-            self.assertEqual(session['logged_in'], False)
+            self.assertNotIn('logged_in', session)
 
     def test_newcategory(self):
         with self.client:
@@ -917,6 +947,8 @@ class BlogTests(TestCase):
             db.session.commit()
             response = self.client.get('/?tag=test', follow_redirects=True)
             self.assertEqual(response.status_code, 200)
+            # Clicks are saved in batches
+            flushTagClicks()
             tag = dbtag.query.filter(dbtag.keyword == 'test').first()
             self.assertIsNotNone(tag)
             self.assertEqual(tag.popularity, 2)
@@ -1306,6 +1338,7 @@ class BlogTests(TestCase):
                 '', 0)
             db.session.add(post)
             db.session.commit()
+            indexPostTags()
             response = self.client.get(
                 '/page?page=0&search=test&tag=test&category=1',
                 follow_redirects=True)
@@ -1402,6 +1435,1109 @@ class BlogTests(TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertIn(b'END.', response.data)
 
+    def test_page_search(self):
+        with self.client:
+            self.make_config_file()
+            category = dbcategory('Other', 0)
+            db.session.add(category)
+            post = dbpost(
+                'firsttitle', 'python flask blog',
+                datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 0, 1,
+                '', 0)
+            db.session.add(post)
+            post = dbpost(
+                'secondtitle', 'python python python',
+                datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 0, 1,
+                '', 0)
+            db.session.add(post)
+            db.session.commit()
+            response = self.client.get('/page?page=0&search=pyth&sort=relevance',
+                                       follow_redirects=True)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b'<mark>python</mark>', response.data)
+            self.assertLess(response.data.find(b'show?id=2'),
+                            response.data.find(b'show?id=1'))
+            response = self.client.get('/page?page=0&search=flask blog',
+                                       follow_redirects=True)
+            self.assertIn(b'show?id=1', response.data)
+            self.assertNotIn(b'show?id=2', response.data)
+            response = self.client.get('/page?page=0&search=%22%2A',
+                                       follow_redirects=True)
+            self.assertIn(b'END.', response.data)
+            # Matches inside the links and hashtags
+            post = dbpost(
+                'thirdtitle', 'see https://ex.com/django/x and #django',
+                datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 0, 1,
+                '', 0)
+            db.session.add(post)
+            db.session.commit()
+            response = self.client.get('/page?page=0&search=django',
+                                       follow_redirects=True)
+            self.assertIn(b"<a href='https://ex.com/django/x' rel='nofollow'>"
+                          b"https://ex.com/<mark>django</mark>/x</a>",
+                          response.data)
+            self.assertIn(b"<a href='/?tag=django' class='hashtag'>"
+                          b"#<mark>django</mark></a>", response.data)
+            # Markers aren't allowed in the other texts
+            self.assertEqual(prcText('a\x02b\x03 #\x02c', ''),
+                             prcText('ab #c', ''))
+            removepost(3)
+            # Edited and deleted posts must be updated in the search index
+            post = dbpost.query.filter(dbpost.postid == 1).first()
+            post.content = 'django'
+            db.session.commit()
+            response = self.client.get('/page?page=0&search=flask',
+                                       follow_redirects=True)
+            self.assertIn(b'END.', response.data)
+            removepost(2)
+            response = self.client.get('/page?page=0&search=python',
+                                       follow_redirects=True)
+            self.assertIn(b'END.', response.data)
+
+    def test_rebuild_search(self):
+        self.make_config_file()
+        category = dbcategory('Other', 0)
+        db.session.add(category)
+        post = dbpost('title', 'searchable content',
+                      datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                      0, 1, '', 0)
+        db.session.add(post)
+        db.session.commit()
+        db.session.execute('DROP TABLE dbpostsearch')
+        db.session.commit()
+        result = app.test_cli_runner().invoke(rebuildsearch)
+        self.assertIn('1 posts', result.output)
+        response = self.client.get('/page?page=0&search=searchable',
+                                   follow_redirects=True)
+        self.assertIn(b'show?id=1', response.data)
+
+    def test_page_tag(self):
+        with self.client:
+            self.login()
+            category = dbcategory('Other', 0)
+            db.session.add(category)
+            db.session.commit()
+            for content in ('first #python', 'second #py', 'third #python'):
+                response = self.client.post('/post',
+                                            data=dict(category='1',
+                                                      disablecomments='No',
+                                                      pinned='No',
+                                                      title='title',
+                                                      mediaaddr='',
+                                                      content=content,
+                                                      postid=''),
+                                            follow_redirects=True)
+                self.assertEqual(response.status_code, 200)
+            self.assertEqual(dbposttag.query.count(), 3)
+            response = self.client.get('/page?page=0&tag=py',
+                                       follow_redirects=True)
+            self.assertIn(b'second', response.data)
+            self.assertNotIn(b'first', response.data)
+            self.assertNotIn(b'third', response.data)
+            response = self.client.get('/page?page=0&tag=python&category=1',
+                                       follow_redirects=True)
+            self.assertIn(b'first', response.data)
+            self.assertIn(b'third', response.data)
+            self.assertNotIn(b'second', response.data)
+            removepost(1)
+            self.assertEqual(dbposttag.query.count(), 2)
+
+    def test_index_tags(self):
+        category = dbcategory('Other', 0)
+        db.session.add(category)
+        db.session.add(dbtag('python', 5, 3))
+        db.session.add(dbtag('unused', 1, 0))
+        for content in ('#python #flask', '#python'):
+            post = dbpost('title', content,
+                          datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                          0, 1, '', 0)
+            db.session.add(post)
+        db.session.commit()
+        result = app.test_cli_runner().invoke(indextags)
+        self.assertIn('3 hashtag links added.', result.output)
+        self.assertEqual(indexPostTags(), 0)
+        tag = dbtag.query.filter(dbtag.keyword == 'python').first()
+        self.assertEqual(tag.frequency, 2)
+        self.assertEqual(tag.popularity, 3)
+        tag = dbtag.query.filter(dbtag.keyword == 'flask').first()
+        self.assertEqual(tag.frequency, 1)
+        tag = dbtag.query.filter(dbtag.keyword == 'unused').first()
+        self.assertIsNone(tag)
+
+    def test_page_cursor(self):
+        with self.client:
+            self.make_config_file()
+            config = getConfig()
+            config['ppp'] = 2
+            saveConfig(config)
+            category = dbcategory('Other', 0)
+            db.session.add(category)
+            for i, comments in enumerate((3, 1, 3, 0, 2)):
+                post = dbpost(
+                    'testtitle%d' % i, 'testcontent%d' % i,
+                    datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    comments, 1, '', 2 if i == 3 else 0)
+                db.session.add(post)
+            db.session.commit()
+            for sort, order in (('descdate', '34210'), ('ascdate', '30124'),
+                                ('desccomments', '32041'),
+                                ('asccomments', '31402')):
+                cursor, found = '', ''
+                while True:
+                    response = self.client.get('/page?sort=%s&cursor=%s' %
+                                               (sort, cursor))
+                    self.assertEqual(response.status_code, 200)
+                    self.assertNotIn(b'END.', response.data)
+                    found += ''.join(re.findall(r'testcontent(\d)',
+                                                response.data.decode()))
+                    cursor = response.headers['X-Next-Cursor']
+                    if response.headers['X-Has-More'] == '0':
+                        break
+                self.assertEqual(found, order)
+            response = self.client.get('/page?sort=descdate&cursor=1.x')
+            self.assertEqual(response.status_code, 400)
+            response = self.client.get('/page?sort=ascdate&cursor=1.0')
+            self.assertEqual(response.status_code, 400)
+            response = self.client.get(
+                '/page?sort=descdate&cursor=99999999999999999999.1')
+            self.assertEqual(response.status_code, 400)
+            response = self.client.get(
+                '/page?sort=descdate&cursor=1.-99999999999999999999')
+            self.assertEqual(response.status_code, 400)
+            response = self.client.get('/page?page=99999999999999999999')
+            self.assertEqual(response.status_code, 400)
+
+    def test_approved_comments(self):
+        with self.client:
+            self.login()
+            category = dbcategory('Other', 0)
+            db.session.add(category)
+            post = dbpost(
+                'testtitle', 'testcontent',
+                datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 0, 1,
+                '', 0)
+            db.session.add(post)
+            db.session.commit()
+            config = getConfig()
+            config['autoapproval'] = 'No'
+            saveConfig(config)
+            self.logout()
+            for name in ('first', 'second'):
+                response = self.client.post('/comments?postid=1',
+                                            data=dict(postid=1,
+                                                      name=name,
+                                                      content='testcomment'),
+                                            follow_redirects=True)
+                self.assertEqual(response.status_code, 200)
+            post = dbpost.query.filter(dbpost.postid == 1).first()
+            self.assertEqual(post.comments, 2)
+            self.assertEqual(post.approved_comments, 0)
+            self.login()
+            for i in range(2):
+                response = self.client.post('/approvecomment',
+                                            data=json.dumps(dict(id=1)),
+                                            content_type='application/json',
+                                            follow_redirects=True)
+                self.assertEqual(response.status_code, 200)
+            post = dbpost.query.filter(dbpost.postid == 1).first()
+            self.assertEqual(post.approved_comments, 1)
+            response = self.client.post('/deletecomment',
+                                        data=json.dumps(dict(id=1)),
+                                        content_type='application/json',
+                                        follow_redirects=True)
+            self.assertEqual(response.status_code, 200)
+            post = dbpost.query.filter(dbpost.postid == 1).first()
+            self.assertEqual(post.comments, 1)
+            self.assertEqual(post.approved_comments, 0)
+            # Not approved comment and a comment which is already deleted
+            for status_code in (200, 400):
+                response = self.client.post('/deletecomment',
+                                            data=json.dumps(dict(id=2)),
+                                            content_type='application/json',
+                                            follow_redirects=True)
+                self.assertEqual(response.status_code, status_code)
+            post = dbpost.query.filter(dbpost.postid == 1).first()
+            self.assertEqual(post.comments, 0)
+            self.assertEqual(post.approved_comments, 0)
+
+    def test_recount_comments(self):
+        post = dbpost('testtitle', 'testcontent',
+                      datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                      5, 1, '', 0)
+        db.session.add(post)
+        for status in (0, 1, 2, 3):
+            comment = dbcomment(
+                1, 'testcomment',
+                datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                'testname', '', '', status)
+            db.session.add(comment)
+        db.session.commit()
+        result = app.test_cli_runner().invoke(recountcomments)
+        self.assertIn('Comments of 1 posts recounted.', result.output)
+        post = dbpost.query.filter(dbpost.postid == 1).first()
+        self.assertEqual(post.comments, 4)
+        self.assertEqual(post.approved_comments, 2)
+
+    def test_upgrade_database(self):
+        category = dbcategory('Other', 0)
+        db.session.add(category)
+        post = dbpost('title', 'pinned #post',
+                      datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                      1, 1, '', 2)
+        db.session.add(post)
+        comment = dbcomment(
+            1, 'testcomment',
+            datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'testname', '', '', 3)
+        db.session.add(comment)
+        db.session.commit()
+        self.assertEqual(getDatabaseVersion(), len(MIGRATIONS))
+        self.assertEqual(upgradeDatabase(), 0)
+        # Turn the database into a version 0 database
+        for model in (dbpost, dbcomment, dbtag):
+            for index in model.__table__.indexes:
+                index.drop(db.engine)
+        db.session.execute('ALTER TABLE dbpost DROP COLUMN pinned')
+        db.session.execute('ALTER TABLE dbpost DROP COLUMN approved_comments')
+        db.session.execute('ALTER TABLE dbpost DROP COLUMN timestamp')
+        db.session.execute('ALTER TABLE dbcomment DROP COLUMN timestamp')
+        db.session.execute('ALTER TABLE dbpost DROP COLUMN html')
+        db.session.execute('ALTER TABLE dbpost DROP COLUMN excerpt')
+        db.session.execute('ALTER TABLE dbpost DROP COLUMN renderer')
+        db.session.execute('DROP TABLE post_tags')
+        db.session.execute('DROP TABLE dbpostsearch')
+        db.session.execute('PRAGMA user_version = 0')
+        db.session.commit()
+        result = app.test_cli_runner().invoke(upgradedb)
+        self.assertIn('%d migrations applied, database version is %d.' %
+                      (len(MIGRATIONS), len(MIGRATIONS)), result.output)
+        post = dbpost.query.filter(dbpost.postid == 1).first()
+        self.assertEqual(post.pinned, 1)
+        self.assertEqual(post.timestamp, toTimestamp(post.gdatetime))
+        self.assertEqual(post.renderer, RENDERER_VERSION)
+        self.assertIn("href='/?tag=post'", post.html)
+        comment = dbcomment.query.filter(dbcomment.cmtid == 1).first()
+        self.assertEqual(comment.timestamp, toTimestamp(comment.gdatetime))
+        self.assertEqual(post.approved_comments, 1)
+        self.assertEqual(dbposttag.query.count(), 1)
+        indexes = [index['name'] for index in
+                   db.inspect(db.engine).get_indexes('dbpost')]
+        self.assertIn('ix_dbpost_pinned_postid', indexes)
+        plan = db.session.execute(
+            'EXPLAIN QUERY PLAN SELECT commentid FROM dbcomment ' + \
+            'WHERE postid = 1 AND status >= 2').fetchall()
+        self.assertIn('ix_dbcomment_postid_status', str(plan))
+        result = app.test_cli_runner().invoke(upgradedb)
+        self.assertIn('0 migrations applied', result.output)
+
+    def test_page_archive(self):
+        with self.client:
+            self.make_config_file()
+            config = getConfig()
+            config['calendar'] = 'Gregorian'
+            saveConfig(config)
+            category = dbcategory('Other', 0)
+            db.session.add(category)
+            for gdatetime in ('2020-02-29 23:59:59', '2020-03-01 00:00:00',
+                              '2020-03-31 12:00:00', '2020-04-01 00:00:00'):
+                post = dbpost('title', 'posted at ' + gdatetime, gdatetime,
+                              0, 1, '', 0)
+                db.session.add(post)
+            db.session.commit()
+            response = self.client.get('/page?archive=2020-03')
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn(b'2020-02-29', response.data)
+            self.assertIn(b'2020-03-01', response.data)
+            self.assertIn(b'2020-03-31', response.data)
+            self.assertNotIn(b'2020-04-01', response.data)
+            response = self.client.get('/page?since=2020-03-31')
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn(b'2020-03-01', response.data)
+            self.assertIn(b'2020-04-01', response.data)
+            # Esfand 1398 (2020-02-20 to 2020-03-19)
+            config['calendar'] = 'Jalali'
+            saveConfig(config)
+            response = self.client.get('/page?archive=1398-12')
+            self.assertIn(b'2020-02-29', response.data)
+            self.assertIn(b'2020-03-01', response.data)
+            self.assertNotIn(b'2020-03-31', response.data)
+            plan = db.session.execute(
+                'EXPLAIN QUERY PLAN SELECT postid FROM dbpost ' + \
+                'WHERE timestamp >= 0 AND timestamp < 1').fetchall()
+            self.assertIn('ix_dbpost_timestamp', str(plan))
+            response = self.client.get('/page?archive=2020-13')
+            self.assertEqual(response.status_code, 400)
+            # Last month of the calendars and years which are too big
+            start, end = monthRange(9377, 12, 'Jalali')
+            self.assertEqual(end - start, 30 * 86400)
+            response = self.client.get('/page?archive=9377-12')
+            self.assertEqual(response.status_code, 200)
+            response = self.client.get('/page?archive=9378-01')
+            self.assertEqual(response.status_code, 400)
+            config['calendar'] = 'Gregorian'
+            saveConfig(config)
+            start, end = monthRange(9999, 12, 'Gregorian')
+            self.assertEqual(end - start, 31 * 86400)
+            response = self.client.get('/page?archive=9999-12')
+            self.assertEqual(response.status_code, 200)
+            response = self.client.get(
+                '/page?archive=99999999999999999999-01')
+            self.assertEqual(response.status_code, 400)
+            response = self.client.get('/page?since=yesterday')
+            self.assertEqual(response.status_code, 400)
+
+    def test_post_tags_diff(self):
+        with self.client:
+            self.login()
+            category = dbcategory('Other', 0)
+            db.session.add(category)
+            db.session.commit()
+            content = ' '.join('#tag%d' % i for i in range(30))
+            data = dict(category='1', disablecomments='No', pinned='No',
+                        title='testtitle', mediaaddr='', content=content,
+                        postid='')
+            self.client.post('/post', data=data, follow_redirects=True)
+            self.assertEqual(dbtag.query.count(), 30)
+            self.assertEqual(dbposttag.query.count(), 30)
+            # Unchanged hashtags must not be touched
+            dbtag.query.filter(dbtag.keyword == 'tag1').update(
+                {dbtag.frequency: 5})
+            db.session.commit()
+            statements = []
+            def countStatement(conn, cursor, statement, *args):
+                statements.append(statement)
+            event.listen(db.engine, 'before_cursor_execute', countStatement)
+            data['postid'] = '1'
+            data['content'] = content.replace('#tag0 ', '#new ')
+            try:
+                self.client.post('/post', data=data)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute',
+                             countStatement)
+            tagStatements = [statement for statement in statements
+                             if 'dbtag' in statement]
+            self.assertLessEqual(len(tagStatements), 5)
+            self.assertIsNone(
+                dbtag.query.filter(dbtag.keyword == 'tag0').first())
+            self.assertEqual(
+                dbtag.query.filter(dbtag.keyword == 'new').first().frequency,
+                1)
+            self.assertEqual(
+                dbtag.query.filter(dbtag.keyword == 'tag1').first().frequency,
+                5)
+            self.assertEqual(dbposttag.query.count(), 30)
+            removepost(1)
+            self.assertEqual(dbposttag.query.count(), 0)
+            self.assertEqual(dbtag.query.count(), 1)
+            # Posts with more hashtags than the variables which older
+            # sqlite versions allow in a statement
+            variables = []
+            def countVariables(conn, cursor, statement, parameters,
+                               context, executemany):
+                if not executemany:
+                    variables.append(len(parameters))
+            event.listen(db.engine, 'before_cursor_execute', countVariables)
+            data['postid'] = ''
+            data['content'] = ' '.join('#many%d' % i for i in range(1200))
+            try:
+                self.client.post('/post', data=data)
+                self.assertEqual(dbposttag.query.count(), 1200)
+                data['postid'] = str(dbpost.query.first().postid)
+                data['content'] = 'no hashtags'
+                self.client.post('/post', data=data)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute',
+                             countVariables)
+            self.assertEqual(dbposttag.query.count(), 0)
+            self.assertEqual(dbtag.query.count(), 1)
+            self.assertLess(max(variables), 999)
+
+    def test_removecategory_bulk(self):
+        with self.client:
+            self.login()
+            db.session.add(dbcategory('removeme', 0))
+            db.session.add(dbcategory('keepme', 0))
+            for i in range(51):
+                category = 2 if i == 50 else 1
+                content = '#shared #only%d' % category
+                post = dbpost('title', content,
+                              datetime.datetime.now().strftime(
+                                  DATETIME_FORMAT), 1, category, '', 0)
+                db.session.add(post)
+                db.session.flush()
+                updateTags(post.postid, '', content)
+                db.session.add(dbcomment(
+                    post.postid, 'testcomment',
+                    datetime.datetime.now().strftime(DATETIME_FORMAT),
+                    'testname', '', '', 3))
+            db.session.commit()
+            statements = []
+            def countStatement(conn, cursor, statement, *args):
+                statements.append(statement)
+            event.listen(db.engine, 'before_cursor_execute', countStatement)
+            try:
+                response = self.client.post('/removecategory',
+                                            data=json.dumps(dict(id=1)),
+                                            content_type='application/json')
+            finally:
+                event.remove(db.engine, 'before_cursor_execute',
+                             countStatement)
+            self.assertEqual(response.status_code, 200)
+            self.assertLess(len(statements), 15)
+            self.assertEqual(dbpost.query.count(), 1)
+            self.assertEqual(dbcomment.query.count(), 1)
+            self.assertEqual(dbposttag.query.count(), 2)
+            tag = dbtag.query.filter(dbtag.keyword == 'shared').first()
+            self.assertEqual(tag.frequency, 1)
+            self.assertIsNone(
+                dbtag.query.filter(dbtag.keyword == 'only1').first())
+            self.assertIsNotNone(
+                dbtag.query.filter(dbtag.keyword == 'only2').first())
+
+    def test_sqlite_pragmas(self):
+        result = app.test_cli_runner().invoke(sqlitestatus)
+        self.assertIn('journal_mode: wal', result.output)
+        self.assertIn('synchronous: 1', result.output)
+        self.assertIn('busy_timeout: 5000', result.output)
+        self.assertIn('temp_store: 2', result.output)
+        self.assertIn('user_version: %d' % len(MIGRATIONS), result.output)
+        with db.engine.connect() as connection:
+            self.assertEqual(
+                connection.execute('PRAGMA cache_size').scalar(),
+                app.config['SQLITE_PRAGMAS']['cache_size'])
+
+    def test_tag_clicks(self):
+        with self.client:
+            flushTagClicks()
+            db.session.add(dbtag('test', 1, 1))
+            db.session.commit()
+            statements = []
+
+            def count(conn, cursor, statement, parameters, context, many):
+                statements.append(statement)
+            event.listen(db.engine, 'before_cursor_execute', count)
+            try:
+                # Unknown hashtags never touch the database
+                self.assertTrue(isKnownTag('test'))
+                del statements[:]
+                countTagClick('nosuchtag')
+                self.assertEqual(statements, [])
+                self.assertNotIn('nosuchtag', tagClicks)
+                # Clicks are buffered until the threshold
+                app.config['TAG_CLICKS_FLUSH_COUNT'] = 3
+                countTagClick('test')
+                countTagClick('test')
+                self.assertEqual(statements, [])
+                countTagClick('test')
+                updates = [s for s in statements if s.startswith('UPDATE')]
+                self.assertEqual(len(updates), 1)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', count)
+                app.config['TAG_CLICKS_FLUSH_COUNT'] = 100
+            self.assertEqual(tagClicks, {})
+            tag = dbtag.query.filter(dbtag.keyword == 'test').first()
+            self.assertEqual(tag.popularity, 4)
+
+    def test_mark_comments_seen(self):
+        with self.client:
+            self.make_config_file()
+            db.session.add(dbcategory('category', 0))
+            db.session.add(dbpost(
+                'title', 'content',
+                datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 4, 1,
+                '', 0))
+            for status in (0, 1, 2, 3):
+                db.session.add(dbcomment(
+                    1, 'content',
+                    datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    'name', '', '', status))
+            db.session.commit()
+            statements = []
+
+            def count(conn, cursor, statement, parameters, context, many):
+                statements.append(statement)
+            event.listen(db.engine, 'before_cursor_execute', count)
+            try:
+                # Visitors never write to the database
+                for url in ('/show?id=1', '/comments?postid=1'):
+                    response = self.client.get(url)
+                    self.assertEqual(response.status_code, 200)
+                self.assertFalse([s for s in statements
+                                  if not s.startswith('SELECT')])
+                # Admin marks all the comments as seen in one statement
+                self.login()
+                del statements[:]
+                response = self.client.get('/show?id=1')
+                self.assertEqual(response.status_code, 200)
+                updates = [s for s in statements if s.startswith('UPDATE')]
+                self.assertEqual(len(updates), 1)
+                self.assertIn('dbcomment.status & ?', updates[0])
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', count)
+            status = [c.status for c in
+                      dbcomment.query.order_by(dbcomment.cmtid).all()]
+            self.assertEqual(status, [1, 1, 3, 3])
+
+    def test_page_projection(self):
+        with self.client:
+            self.make_config_file()
+            content = 'word ' * 200 + 'tail'
+            db.session.add(dbpost(
+                'title', content,
+                datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 0, 1,
+                '', 0))
+            db.session.commit()
+            statements = []
+
+            def count(conn, cursor, statement, parameters, context, many):
+                statements.append(statement)
+            event.listen(db.engine, 'before_cursor_execute', count)
+            try:
+                response = self.client.get('/page?cursor=')
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', count)
+            self.assertEqual(response.status_code, 200)
+            # Only the rendered excerpt of the content is loaded
+            query = [s for s in statements if 'FROM dbpost' in s][0]
+            self.assertIn('dbpost.excerpt', query)
+            self.assertNotIn('dbpost.content', query)
+            self.assertIn(tr('Continue Reading...').encode(), response.data)
+            self.assertNotIn(b'tail', response.data)
+
+    def test_rendered_content(self):
+        with self.client:
+            self.make_config_file()
+            db.session.add(dbcategory('category', 0))
+            content = 'hello #dear\nuser! ' + 'word ' * 120
+            db.session.add(dbpost(
+                'title', content,
+                datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 0, 1,
+                '', 0))
+            db.session.commit()
+            post = dbpost.query.filter(dbpost.postid == 1).first()
+            # Content is rendered when it's saved (with relative links)
+            self.assertTrue(post.html.startswith(
+                "hello <a href='/?tag=dear' class='hashtag'>#dear</a><br>"))
+            self.assertTrue(post.excerpt.endswith('word...'))
+            self.assertEqual(post.renderer, RENDERER_VERSION)
+            self.assertEqual(str(withScriptRoot(post.html, '/blog')),
+                             str(prcText(content, '/blog')))
+            # Outdated posts are rendered again in bulk
+            dbpost.query.update({dbpost.html: '', dbpost.renderer: 0},
+                                synchronize_session=False)
+            db.session.commit()
+            result = app.test_cli_runner().invoke(renderposts)
+            self.assertIn('1 posts rendered.', result.output)
+            response = self.client.get('/show?id=1')
+            self.assertIn(b"href='/?tag=dear'", response.data)
+            result = app.test_cli_runner().invoke(renderposts, ['--all'])
+            self.assertIn('1 posts rendered.', result.output)
+            # Upgrades render the posts only if the renderer version
+            # which is saved in the database is older
+            self.assertEqual(getRendererVersion(), RENDERER_VERSION)
+            dbpost.query.update({dbpost.renderer: 0},
+                                synchronize_session=False)
+            db.session.commit()
+            upgradeDatabase()
+            post = dbpost.query.filter(dbpost.postid == 1).first()
+            self.assertEqual(post.renderer, 0)
+            setDatabaseVersion(getDatabaseVersion(), RENDERER_VERSION - 1)
+            db.session.commit()
+            upgradeDatabase()
+            post = dbpost.query.filter(dbpost.postid == 1).first()
+            self.assertEqual(post.renderer, RENDERER_VERSION)
+            self.assertEqual(getRendererVersion(), RENDERER_VERSION)
+            self.assertEqual(getDatabaseVersion(), len(MIGRATIONS))
+            # Older databases don't have the renderer version, it's found
+            # using the posts (which may be already rendered)
+            setDatabaseVersion(getDatabaseVersion(), 0)
+            db.session.commit()
+            with mock.patch('blog.app.renderPosts') as render:
+                upgradeDatabase()
+                render.assert_not_called()
+            self.assertEqual(getRendererVersion(), RENDERER_VERSION)
+            setDatabaseVersion(getDatabaseVersion(), 0)
+            dbpost.query.update({dbpost.renderer: 0},
+                                synchronize_session=False)
+            db.session.commit()
+            upgradeDatabase()
+            post = dbpost.query.filter(dbpost.postid == 1).first()
+            self.assertEqual(post.renderer, RENDERER_VERSION)
+
+    def test_prcText_tokens(self):
+        # Overlapping hashtags are linked separately
+        ret = prcText('#py #python', '')
+        self.assertEqual(ret, Markup(
+            "<a href='/?tag=py' class='hashtag'>#py</a> " + \
+            "<a href='/?tag=python' class='hashtag'>#python</a>"))
+        # Web addresses are linked and the rest is escaped
+        ret = prcText('<b>see</b> https://site.com/a?b=1&c=2#top.\nbye',
+                      '/blog')
+        self.assertEqual(ret, Markup(
+            "&lt;b&gt;see&lt;/b&gt; <a href='https://site.com/a?b=1&amp;" + \
+            "c=2#top' rel='nofollow'>https://site.com/a?b=1&amp;c=2#top" + \
+            "</a>.<br>bye"))
+        self.assertEqual(prcText('"#tag"\r\n', ''), Markup(
+            "&#34;<a href='/?tag=tag' class='hashtag'>#tag</a>&#34;<br>"))
+
+    def test_page_cache(self):
+        with self.client:
+            self.login()
+            hits = cacheStats['page', 'hits']
+            misses = cacheStats['page', 'misses']
+            db.session.add(dbcategory('category', 0))
+            db.session.add(dbpost(
+                'title', 'first post',
+                datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 0, 1,
+                '', 0))
+            db.session.commit()
+            response = self.client.get('/page?cursor=')
+            self.assertEqual(response.headers['X-Cache'], 'MISS')
+            response = self.client.get('/page?cursor=')
+            self.assertEqual(response.headers['X-Cache'], 'HIT')
+            self.assertIn(b'first post', response.data)
+            self.assertEqual(response.headers['X-Has-More'], '0')
+            # Other arguments are cached separately
+            response = self.client.get('/page?cursor=&sort=ascdate')
+            self.assertEqual(response.headers['X-Cache'], 'MISS')
+            # Saving a post invalidates the cached pages
+            self.client.post('/post', data=dict(
+                category='1', disablecomments='No', pinned='No',
+                title='title', mediaaddr='http://testaddr.com',
+                content='second post'))
+            response = self.client.get('/page?cursor=')
+            self.assertEqual(response.headers['X-Cache'], 'MISS')
+            self.assertIn(b'second post', response.data)
+            response = self.client.get('/page?cursor=')
+            self.assertEqual(response.headers['X-Cache'], 'HIT')
+            # A new comment invalidates the cached pages too
+            self.client.post('/comments?postid=1', data=dict(
+                name='name', content='comment', postid=1))
+            response = self.client.get('/page?cursor=')
+            self.assertEqual(response.headers['X-Cache'], 'MISS')
+            self.assertEqual(cacheStats['page', 'hits'] - hits, 2)
+            self.assertEqual(cacheStats['page', 'misses'] - misses, 4)
+            stats = json.loads(self.client.get('/cachestats').data)
+            self.assertEqual(stats['page']['ratio'],
+                             cacheStats['page', 'hits'] / (
+                                 cacheStats['page', 'hits'] +
+                                 cacheStats['page', 'misses']))
+            # Pages are cached separately for each version of translations
+            response = self.client.get('/page?cursor=')
+            self.assertEqual(response.headers['X-Cache'], 'HIT')
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, 'translation.json')
+                with open(path, 'w', encoding='utf-8') as translationFile:
+                    json.dump({'Monday': 'Mon'}, translationFile)
+                with mock.patch('blog.app.TRANSLATIONS_FILE', path):
+                    response = self.client.get('/page?cursor=')
+                    self.assertEqual(response.headers['X-Cache'], 'MISS')
+
+    def test_sidebar_cache(self):
+        with self.client:
+            self.login()
+            db.session.add(dbcategory('category', 0))
+            db.session.commit()
+            statements = []
+
+            def count(conn, cursor, statement, parameters, context, many):
+                statements.append(statement)
+            event.listen(db.engine, 'before_cursor_execute', count)
+            try:
+                response = self.client.get('/')
+                self.assertIn(b'category', response.data)
+                del statements[:]
+                # Sidebar doesn't query the database until something changes
+                response = self.client.get('/')
+                self.assertEqual(response.status_code, 200)
+                self.assertFalse([s for s in statements if 'dblink' in s or
+                                  'dbcategory' in s or 'dbtag' in s])
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', count)
+            response = self.client.post('/addlink',
+                                        data=json.dumps(dict(
+                                            name='testlink',
+                                            address='http://link.com')),
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            response = self.client.post('/editcategory',
+                                        data=json.dumps(dict(
+                                            id=1, name='renamed')),
+                                        content_type='application/json')
+            response = self.client.get('/')
+            self.assertIn(b'testlink', response.data)
+            self.assertIn(b'renamed', response.data)
+
+    def test_shared_cache(self):
+        # Worker processes share the cache (and its invalidations)
+        cache.set('counter', 0)
+        generation = getGenerations('posts')
+        context = multiprocessing.get_context('fork')
+        processes = [context.Process(target=incrementCache, args=(50,))
+                     for i in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+        self.assertEqual(cache.get('counter'), 200)
+        self.assertNotEqual(getGenerations('posts'), generation)
+        # Least recently used and expired items are removed
+        with tempfile.TemporaryDirectory() as directory:
+            small = SQLiteCache(os.path.join(directory, 'cache.db'),
+                                threshold=4, touchInterval=0,
+                                pruneInterval=1)
+            for i in range(4):
+                small.set(str(i), i)
+            self.assertEqual(small.get('0'), 0)
+            small.set('4', 4)
+            self.assertEqual(small.get_many('0', '1', '4'), [0, None, 4])
+            small.set('ttl', 'value', timeout=0.05)
+            self.assertTrue(small.has('ttl'))
+            time.sleep(0.1)
+            self.assertIsNone(small.get('ttl'))
+            self.assertTrue(small.add('ttl', 'new'))
+            self.assertFalse(small.add('ttl', 'newer'))
+            self.assertEqual(small.get('ttl'), 'new')
+            # Corrupt values are misses
+            connection = sqlite3.connect(os.path.join(directory, 'cache.db'))
+            connection.execute("UPDATE cache SET value = x'00' " +
+                               "WHERE key = 'ttl'")
+            connection.commit()
+            self.assertIsNone(small.get('ttl'))
+            self.assertIsNone(small.inc('ttl'))
+            # Errors of the cache file don't fail the requests
+            connection.execute('DROP TABLE cache')
+            connection.commit()
+            connection.close()
+            with self.assertLogs('blog.sqlitecache', 'WARNING'):
+                self.assertEqual(small.get_many('0', '4'), [None, None])
+                self.assertFalse(small.set('0', 0))
+                self.assertFalse(small.add('5', 5))
+                self.assertIsNone(small.inc('counter'))
+                self.assertFalse(small.has('0'))
+                self.assertFalse(small.delete('0'))
+                self.assertFalse(small.clear())
+
+    def test_config_version(self):
+        with self.client:
+            self.make_config_file()
+            self.assertEqual(getConfig()['ppp'], 10)
+            # Another worker saves a new config
+            config = getConfig().copy()
+            config['ppp'] = 3
+            with open(CONFIG_FILE + '.new', 'w') as configFile:
+                json.dump(config, configFile)
+            os.replace(CONFIG_FILE + '.new', CONFIG_FILE)
+            stats = []
+            realStat = os.stat
+
+            def stat(path, *args, **kwargs):
+                if path == CONFIG_FILE:
+                    stats.append(path)
+                return realStat(path, *args, **kwargs)
+            # The config file is checked once in each request
+            with mock.patch('blog.app.os.stat', side_effect=stat):
+                response = self.client.get('/')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(stats), 1)
+            self.assertEqual(getConfig()['ppp'], 3)
+            self.assertFalse(os.path.exists(
+                '%s.%d.tmp' % (CONFIG_FILE, os.getpid())))
+
+    def test_datetime_cache(self):
+        with self.client:
+            self.make_config_file()
+            formatCalendarDateTime.cache_clear()
+            timestamp = toTimestamp('2020-03-20 10:00:00')
+            jalali = formatDateTime(timestamp, '%Y-%m-%d')
+            self.assertEqual(jalali, '1399-1-1')
+            # Strings are converted before lookup so they share the entry
+            self.assertEqual(formatDateTime('2020-03-20 10:00:00',
+                                            '%Y-%m-%d'), jalali)
+            info = formatCalendarDateTime.cache_info()
+            self.assertEqual((info.hits, info.misses), (1, 1))
+            # Changing the calendar invalidates the formatted dates
+            config = getConfig().copy()
+            config['calendar'] = 'Gregorian'
+            saveConfig(config)
+            self.assertEqual(formatCalendarDateTime.cache_info().currsize, 0)
+            self.assertEqual(formatDateTime(timestamp, '%Y-%m-%d'),
+                             '2020-3-20')
+            self.login()
+            stats = json.loads(self.client.get('/cachestats').data)
+            self.assertIn('evictions', stats['datetime'])
+            self.assertEqual(stats['datetime']['maxsize'],
+                             app.config['DATETIME_CACHE_SIZE'])
+
+    def test_translations_catalog(self):
+        catalog = getTranslations()
+        # The package's translations file is used (not the current directory)
+        self.assertEqual(TRANSLATIONS_FILE, os.path.join(
+            os.path.dirname(blog.app.__file__), 'translation.json'))
+        self.assertIs(getTranslations(), catalog)
+        self.assertEqual(catalog.days[0], tr('Monday'))
+        self.assertEqual(catalog.jmonths[12], tr('Esfand'))
+        self.assertEqual(catalog.gmonths[1], tr('January'))
+        with self.assertRaises(TypeError):
+            catalog.strings['Monday'] = 'Mon'
+        # The catalog is replaced when the file changes
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'translation.json')
+            with open(path, 'w', encoding='utf-8') as translationFile:
+                json.dump({'Monday': 'Mon', 'Sunday': ''}, translationFile)
+            # The file is checked once in each request
+            with mock.patch('blog.app.TRANSLATIONS_FILE', path), \
+                    app.test_request_context():
+                self.assertEqual(tr('Monday'), 'Mon')
+                # Empty translations are ignored
+                self.assertEqual(tr('Sunday'), 'Sunday')
+                self.assertEqual(getTranslations().days[0], 'Mon')
+                os.remove(path)
+                self.assertEqual(tr('Monday'), 'Mon')
+            with mock.patch('blog.app.TRANSLATIONS_FILE', path), \
+                    app.test_request_context():
+                self.assertEqual(tr('Monday'), 'Monday')
+        with app.test_request_context():
+            self.assertEqual(tr('Monday'), catalog.strings['Monday'])
+
+    def test_anonymous_responses(self):
+        self.make_config_file()
+        db.session.add(dbcategory('category', 0))
+        db.session.add(dbpost(
+            'title', 'content',
+            datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 0, 1,
+            '', 0))
+        db.session.commit()
+        # Visitors have no cookies
+        visitor = app.test_client(use_cookies=False)
+        with mock.patch.dict(app.config, {'WTF_CSRF_ENABLED': True}):
+            for url in ('/', '/page?cursor=', '/show?id=1',
+                        '/comments?postid=1'):
+                response = visitor.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertNotIn('Set-Cookie', response.headers)
+            # Public pages are the same for all visitors
+            self.assertEqual(visitor.get('/show?id=1').data,
+                             visitor.get('/show?id=1').data)
+            # The CSRF token is requested only before submitting a form
+            response = visitor.get('/csrftoken')
+            self.assertIn('Set-Cookie', response.headers)
+            self.assertEqual(response.headers['Cache-Control'], 'no-store')
+
+    def test_conditional_responses(self):
+        self.make_config_file()
+        db.session.add(dbcategory('category', 0))
+        db.session.add(dbpost(
+            'title', 'content',
+            datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 0, 1,
+            '', 0))
+        db.session.commit()
+        visitor = app.test_client(use_cookies=False)
+        response = visitor.get('/show?id=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Cache-Control'], 'public, no-cache')
+        etag = response.headers['ETag']
+        lastModified = response.headers['Last-Modified']
+        # The page isn't generated again
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, many):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            response = visitor.get('/show?id=1',
+                                   headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.data, b'')
+            response = visitor.get('/show?id=1',
+                                   headers={'If-Modified-Since': lastModified})
+            self.assertEqual(response.status_code, 304)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        self.assertEqual(statements, [])
+        # Each page has its own ETag
+        self.assertNotEqual(visitor.get('/show?id=2').headers.get('ETag'),
+                            etag)
+        # A new comment changes the page
+        bumpGenerations('comments')
+        response = visitor.get('/show?id=1', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        # Admins' pages don't have validators and aren't public
+        with self.client:
+            self.login()
+            response = self.client.get('/show?id=1',
+                                       headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('ETag', response.headers)
+            self.assertEqual(response.headers['Cache-Control'],
+                             'private, no-cache')
+
+    def test_static_assets(self):
+        self.assertEqual(minifyCss('/* x */\na  :hover {\n\tcolor : red;\n'
+                                   '\tmargin: 0 1px;\n}\n'),
+                         'a :hover{color :red;margin:0 1px}')
+        with tempfile.TemporaryDirectory() as directory:
+            static = os.path.join(directory, 'static')
+            shutil.copytree(app.static_folder, static)
+            manifest = buildAssets(static)
+            self.assertEqual(loadManifest(static), manifest)
+            styles = manifest['styles.css']
+            self.assertRegex(styles, r'^dist/styles\.[0-9a-f]{10}\.css$')
+            with open(os.path.join(static, styles), 'r') as cssFile:
+                css = cssFile.read()
+            # Fonts are linked using their built names
+            self.assertIn("url('%s')" % os.path.relpath(
+                manifest['fonts/vazir.woff'], 'dist'), css)
+            self.assertNotIn('/*', css)
+            self.assertTrue(os.path.isfile(os.path.join(static,
+                                                        styles + '.gz')))
+            self.assertFalse(os.path.isfile(os.path.join(
+                static, manifest['fonts/vazir.woff'] + '.gz')))
+            staticFolder = app.static_folder
+            app.static_folder = static
+            try:
+                self.checkStaticAssets(manifest, styles, css)
+            finally:
+                app.static_folder = staticFolder
+
+    def checkStaticAssets(self, manifest, styles, css):
+        with mock.patch('blog.app.staticAssets', manifest):
+            self.assertEqual(url_for('static', filename='styles.css'),
+                             '/static/' + styles)
+            response = self.client.get('/static/' + styles,
+                                       headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(response.mimetype, 'text/css')
+            self.assertIn('immutable', response.headers['Cache-Control'])
+            self.assertEqual(gzip.decompress(response.data).decode(), css)
+            response.close()
+            response = self.client.get('/static/' + styles)
+            self.assertNotIn('Content-Encoding', response.headers)
+            self.assertEqual(response.data.decode(), css)
+            response.close()
+
+    def test_font_characters(self):
+        characters = fontCharacters(
+            os.path.join(app.root_path, app.template_folder),
+            TRANSLATIONS_FILE)
+        # Persian and latin digits, letters and the characters
+        # of the templates and the translations
+        for text in ('0123456789', '۰۱۲۳۴۵۶۷۸۹', 'ژپچگکی', 'AZaz',
+                     tr('Continue Reading...'), '»'):
+            self.assertTrue(set(map(ord, text)) <= characters, text)
+        self.assertNotIn(ord('\n'), characters)
+        # Only the templates of the directories are read
+        with tempfile.TemporaryDirectory() as directory:
+            os.mkdir(os.path.join(directory, 'partials.html'))
+            with open(os.path.join(directory, 'page.html'), 'w',
+                      encoding='utf-8') as template:
+                template.write('\u2605')
+            with open(os.path.join(directory, 'notes.txt'), 'w',
+                      encoding='utf-8') as notes:
+                notes.write('\u2606')
+            characters = fontCharacters(directory)
+            self.assertIn(0x2605, characters)
+            self.assertNotIn(0x2606, characters)
+        # Stylesheets prefer the WOFF2 fonts
+        with open(os.path.join(app.static_folder, 'styles.css'), 'r',
+                  encoding='utf-8') as cssFile:
+            css = cssFile.read()
+        self.assertLess(css.index("vazir.woff2') format('woff2')"),
+                        css.index("vazir.woff') format('woff')"))
+        self.assertTrue(os.path.isfile(os.path.join(
+            app.static_folder, 'fonts', 'vazir.woff2')))
+
+    @unittest.skipIf(importlib.util.find_spec('fontTools') is None,
+                     'fontTools is not installed')
+    def test_subset_fonts(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ('yekan.ttf', 'yekan.woff'):
+                shutil.copy(os.path.join(app.static_folder, 'fonts', name),
+                            directory)
+            results = subsetFonts(directory, fontCharacters())
+            self.assertEqual([result[0] for result in results], ['yekan'])
+            self.assertLess(results[0][2], results[0][1])
+            with open(os.path.join(directory, 'yekan.woff2'), 'rb') as font:
+                self.assertEqual(font.read(4), b'wOF2')
+            # Fonts which don't have a .woff version
+            os.remove(os.path.join(directory, 'yekan.woff'))
+            results = subsetFonts(directory, fontCharacters())
+            self.assertEqual(results[0][1], os.path.getsize(
+                os.path.join(directory, 'yekan.ttf')))
+
+    def test_negotiate_encoding(self):
+        self.assertEqual(negotiateEncoding('gzip, deflate'), 'gzip')
+        self.assertEqual(negotiateEncoding('deflate, x-gzip'), 'gzip')
+        self.assertEqual(negotiateEncoding('*'), ENCODINGS[0])
+        self.assertIsNone(negotiateEncoding('gzip;q=0, deflate'))
+        self.assertIsNone(negotiateEncoding(''))
+        self.assertEqual(compressedETag('"abc"', 'gzip'), '"abc-gzip"')
+        self.assertEqual(compressedETag('"abc-gzip"', 'gzip'), '"abc-gzip"')
+
+    def test_response_compression(self):
+        self.make_config_file()
+        visitor = app.test_client(use_cookies=False)
+        response = visitor.get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertEqual(int(response.headers['Content-Length']),
+                         len(response.data))
+        self.assertIn(b'Blog Title', gzip.decompress(response.data))
+        # Compressed responses have their own ETags
+        etag = response.headers['ETag']
+        self.assertTrue(etag.endswith('-gzip"'))
+        self.assertEqual(visitor.get('/').headers['ETag'],
+                         etag.replace('-gzip', ''))
+        response = visitor.get('/', headers={'Accept-Encoding': 'gzip',
+                                             'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        # Small responses aren't compressed
+        response = visitor.get('/csrftoken',
+                               headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        # Responses which won't be compressed aren't buffered
+        body = iter([b'\x89PNG' * 1000])
+
+        def image(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'image/png')])
+            return body
+        environ = {'HTTP_ACCEPT_ENCODING': 'gzip', 'REQUEST_METHOD': 'GET'}
+        started = []
+        result = CompressionMiddleware(image)(
+            environ, lambda status, headers, exc_info=None:
+            started.append(headers))
+        self.assertIs(result, body)
+        self.assertEqual(started, [[('Content-Type', 'image/png')]])
+
+    def test_compressed_page_cache(self):
+        self.make_config_file()
+        db.session.add(dbcategory('category', 0))
+        for i in range(5):
+            db.session.add(dbpost(
+                'title', 'word ' * 100,
+                datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 0, 1,
+                '', 0))
+        db.session.commit()
+        visitor = app.test_client(use_cookies=False)
+        with mock.patch('blog.app.compress', wraps=compress) as compressor:
+            for status in ('MISS', 'HIT', 'HIT'):
+                response = visitor.get('/page?cursor=',
+                                       headers={'Accept-Encoding': 'gzip'})
+                self.assertEqual(response.headers['X-Cache'], status)
+                self.assertEqual(response.headers['Content-Encoding'],
+                                 'gzip')
+                self.assertIn(b'word word', gzip.decompress(response.data))
+            # The page is compressed once
+            self.assertEqual(compressor.call_count, 1)
+            response = visitor.get('/page?cursor=')
+            self.assertEqual(response.headers['X-Cache'], 'HIT')
+            self.assertNotIn('Content-Encoding', response.headers)
+            self.assertIn(b'word word', response.data)
+
     # TODO: Add more tests!
 
 